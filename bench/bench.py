@@ -0,0 +1,262 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import contextlib
+import tracemalloc
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BFPP_DIR = os.path.join(ROOT, "bfpp")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BFPP_DIR)
+
+import lldbf
+from main import compile_path_to_str
+
+# Benchmarks the compiler and lldbf on the bfpp programs in PROGRAM_DIRS.
+# Every program is compiled with compile_path_to_str and the code is run with
+# lldbf.run_program, each time in a freshly forked process, so that caches
+# filled by one program (such as the built macros) don't speed up the next.
+
+# Relative to bfpp/
+PROGRAM_DIRS = ["example-code", "stdlib"]
+
+# Input for the programs that read any. Reading past the end stops the program.
+INPUTS = {
+    "example-code/hex.bfpp": b"The quick brown fox jumps over the lazy dog\n" * 4 + b"\0",
+    "example-code/str_cmp.bfpp": b"abcdefghijklmnopqrstuvwxyz" * 4 + b" " + b"abcdefghijklmnopqrstuvwxyz" * 4 + b"\0",
+}
+
+# Compared against the baseline with the threshold, as they change from run to run
+NOISY_METRICS = ["compile_time", "compile_peak_kib", "load_time", "run_time", "max_rss_kib"]
+# Compared exactly
+EXACT_METRICS = ["code_size", "units", "instructions", "output_size"]
+
+# Seconds a timing has to change by, on top of the threshold, to be reported
+MIN_TIME_CHANGE = 0.02
+
+STATUS = {
+    None: "ok",
+    lldbf.RUN_INPUT: "out of input",
+    lldbf.RUN_INTERRUPT: "interrupted",
+    lldbf.RUN_TAPE_LIMIT: "tape limit",
+}
+
+
+def find_programs():
+    programs = []
+    for directory in PROGRAM_DIRS:
+        for name in sorted(os.listdir(os.path.join(BFPP_DIR, directory))):
+            if name.endswith(".bfpp"):
+                programs.append(directory + "/" + name)
+    return programs
+
+
+# Collects the output of the program instead of printing it
+class Output:
+    def __init__(self):
+        self.history = bytearray()
+
+    def write(self, val):
+        self.history.append(val)
+
+
+# Compiles and runs program once
+# With trace, only the compiler runs, with tracemalloc following its memory use.
+# Tracing slows everything down, and the interpreter about 15 times, so the
+# memory of the whole process is used for the rest instead.
+def measure(program, optimize, trace):
+    res = {"status": "ok"}
+    path = os.path.join(BFPP_DIR, program)
+
+    if trace:
+        tracemalloc.start()
+
+    # The compiler prints warnings, which aren't wanted between the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        code = compile_path_to_str(path, use_cache=False)
+        res["compile_time"] = time.perf_counter() - start
+
+    if trace:
+        res["compile_peak_kib"] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+        return res
+
+    res["code_size"] = len(code)
+
+    start = time.perf_counter()
+    units = lldbf.parse_code(code)
+    if optimize:
+        units = lldbf.optimize_units(units)
+    res["load_time"] = time.perf_counter() - start
+    res["units"] = len(units)
+
+    tape = lldbf.Tape()
+    output = Output()
+    start = time.perf_counter()
+    executed, reason = lldbf.run_program(units, tape, output, list(INPUTS.get(program, b"")))
+    res["run_time"] = time.perf_counter() - start
+
+    # In KiB on Linux
+    res["max_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    res["instructions"] = executed
+    res["output_size"] = len(output.history)
+    res["status"] = STATUS[reason]
+
+    return res
+
+
+def child_main(conn, program, optimize, trace):
+    try:
+        res = measure(program, optimize, trace)
+    except BaseException as e:
+        # compile_path_to_str exits on compilation errors
+        res = {"status": "error: " + repr(e)}
+    conn.send(res)
+    conn.close()
+
+
+def measure_isolated(program, optimize, trace):
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=child_main, args=(child_conn, program, optimize, trace))
+    proc.start()
+    child_conn.close()
+
+    try:
+        res = parent_conn.recv()
+    except EOFError:
+        res = {"status": "error: process died"}
+    proc.join()
+    return res
+
+
+# Timings and memory use are the lowest out of repeat runs
+def bench_program(program, optimize, repeat):
+    res = measure_isolated(program, optimize, False)
+    if res["status"].startswith("error"):
+        return res
+
+    for _ in range(repeat - 1):
+        timed = measure_isolated(program, optimize, False)
+        for metric in ["compile_time", "load_time", "run_time", "max_rss_kib"]:
+            res[metric] = min(res[metric], timed.get(metric, res[metric]))
+
+    traced = measure_isolated(program, optimize, True)
+    res["compile_peak_kib"] = traced.get("compile_peak_kib")
+    return res
+
+
+def format_value(metric, value):
+    if value is None:
+        return "-"
+    if metric.endswith("_time"):
+        return "{:.3f}s".format(value)
+    return str(value)
+
+
+COLUMNS = ["compile_time", "compile_peak_kib", "code_size", "instructions", "output_size", "run_time", "max_rss_kib"]
+
+
+def print_results(results):
+    name_width = max(len(name) for name in list(results["programs"]) + ["program"])
+    print("program".ljust(name_width), *[col.rjust(16) for col in COLUMNS], " status")
+    for name, res in results["programs"].items():
+        values = [format_value(col, res.get(col)).rjust(16) for col in COLUMNS]
+        print(name.ljust(name_width), *values, "", res["status"])
+
+
+# Prints the changes from baseline to out and returns whether any of them is a
+# regression
+def compare(results, baseline, threshold, out):
+    regressed = False
+    old_programs = baseline["programs"]
+
+    for name, res in results["programs"].items():
+        if name not in old_programs:
+            print(name + ": not in the baseline", file=out)
+            continue
+        old = old_programs[name]
+
+        if res["status"] != old["status"]:
+            print("{}: status changed from {} to {}".format(name, old["status"], res["status"]), file=out)
+            regressed = True
+
+        for metric in NOISY_METRICS + EXACT_METRICS:
+            if metric not in res or metric not in old:
+                continue
+            new_value, old_value = res[metric], old[metric]
+
+            if metric in EXACT_METRICS:
+                worse = new_value > old_value
+                changed = new_value != old_value
+            else:
+                if metric.endswith("_time") and abs(new_value - old_value) <= MIN_TIME_CHANGE:
+                    # Changes in very short timings are mostly noise
+                    continue
+                worse = new_value > old_value * (1 + threshold)
+                changed = worse or new_value < old_value * (1 - threshold)
+
+            if not changed:
+                continue
+
+            if old_value != 0:
+                change = "{:+.1f}%".format((new_value - old_value) / old_value * 100)
+            else:
+                change = "new"
+            print("{}: {} {} -> {} ({}){}".format(
+                name, metric, format_value(metric, old_value), format_value(metric, new_value),
+                change, " REGRESSION" if worse else ""), file=out)
+            regressed = regressed or worse
+
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bfpp compiler and lldbf")
+    parser.add_argument("programs", nargs="*", help="programs to run, relative to bfpp/ (default: all of " + ", ".join(PROGRAM_DIRS) + ")")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="take the best time out of this many runs (at least 1)")
+    parser.add_argument("-O", dest="optimize", action="store_true", help="run with lldbf's idiom optimizer")
+    parser.add_argument("-o", "--output", help="save the results as JSON to this file")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON instead of a table")
+    parser.add_argument("--baseline", help="compare against results saved with -o, exits with 1 on regressions")
+    parser.add_argument("--threshold", type=float, default=0.15, help="relative change in timings and memory that counts as a regression (default: 0.15)")
+    args = parser.parse_args()
+
+    programs = args.programs or find_programs()
+
+    results = {
+        "python": sys.version.split()[0],
+        "optimize": args.optimize,
+        "programs": {},
+    }
+    for program in programs:
+        results["programs"][program] = bench_program(program, args.optimize, args.repeat)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        # Keep stdout valid JSON
+        out = sys.stderr if args.json else sys.stdout
+
+        if baseline.get("optimize") != args.optimize:
+            print("Warning: the baseline was made with{} -O".format("" if baseline.get("optimize") else "out"), file=out)
+
+        print(file=out)
+        if compare(results, baseline, args.threshold, out):
+            exit(1)
+        print("No regressions", file=out)
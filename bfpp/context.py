@@ -64,6 +64,10 @@ class StateDelta:
 
     __repr__ = __str__
 
+# States share their dicts with the states derived from them, so they are never
+# changed in place: assign a changed copy instead. macros, types and
+# expansions are shared by the whole compilation and are the exception, new
+# entries are added in place.
 class State:
     def __init__(self):
         self.cell_values = defaultdict(int)
@@ -72,6 +76,7 @@ class State:
 
         self.macros = {}
         self.types = {} # {name: type}
+        self.expansions = {} # Cached macro expansions, see InvokeMacro.expand
 
         self.named_locations = {} # {name: idx}
         self.name_type_names = {} # {name: type_name}
@@ -80,6 +85,9 @@ class State:
 
         self.quiet = False
 
+        # Number of processes to dry-run macro definitions in, see dryrun.py
+        self.jobs = 1
+
     def copy(self):
         return self.with_delta_applied(StateDelta())
 
@@ -114,19 +122,23 @@ class State:
         result = State()
         result.ptr = self.ptr + delta.ptr_delta
         result.ptr_id = self.ptr_id
-        result.named_locations = self.named_locations.copy()
-        result.name_type_names = self.name_type_names.copy()
-        result.cell_values = self.cell_values.copy()
-        result.macros = self.macros.copy()
-        result.types = self.types.copy()
+        result.named_locations = self.named_locations
+        result.name_type_names = self.name_type_names
+        result.cell_values = self.cell_values
+        result.macros = self.macros
+        result.types = self.types
+        result.expansions = self.expansions
         result.n_errors = self.n_errors
         result.quiet = self.quiet
+        result.jobs = self.jobs
 
         if delta.ptr_id_delta != 0:
             result.cell_values = defaultdict(lambda: None)
             result.ptr = 0
             result.ptr_id = self.ptr_id + delta.ptr_id_delta
             result.named_locations = {}
+        elif delta.cell_actions:
+            result.cell_values = self.cell_values.copy()
 
         for idx, action in delta.cell_actions.items():
             idx += self.ptr
@@ -0,0 +1,52 @@
+import io
+from contextlib import redirect_stdout
+
+# Macro definitions are dry-run in ctx.jobs processes. With 1, every macro is
+# dry-run when it is defined.
+
+# Shortest run of consecutive macro definitions worth sending to a pool
+MIN_BATCH = 4
+
+# The batch being dry-run, inherited by the forked workers
+BATCH = None
+
+# Dry-runs macro i of BATCH in the state it would have had when it was defined.
+# Returns what the dry-run printed, or None if it defined macros or types, which
+# would have to be visible to the rest of the program.
+def dry_run_job(i):
+    ctx, jobs = BATCH
+    macro, n_macros = jobs[i]
+
+    # Copied this way to keep the type of the table, see init_macros.py
+    macros = ctx.macros.copy()
+    for name in list(macros.keys())[n_macros:]:
+        del macros[name]
+    n_types = len(ctx.types)
+
+    printed = io.StringIO()
+    with redirect_stdout(printed):
+        macro.dry_run(ctx, macros)
+
+    if len(macros) != n_macros or len(ctx.types) != n_types:
+        return None
+
+    return printed.getvalue()
+
+# jobs is a list of (macro, number of macros in ctx.macros before it was
+# defined). Returns the output of each dry-run in order, or None if any of them
+# has to be run in the main process.
+def dry_run_all(ctx, jobs):
+    global BATCH
+    import multiprocessing
+
+    BATCH = (ctx, jobs)
+    try:
+        with multiprocessing.get_context("fork").Pool(ctx.jobs) as pool:
+            printed = pool.map(dry_run_job, range(len(jobs)))
+    finally:
+        BATCH = None
+
+    if None in printed:
+        return None
+
+    return printed
@@ -0,0 +1,91 @@
+from postproc import PostProc
+from sourcemap import SourceMap
+
+# Emitters collect the code generated by BFPPToken.compile. Tokens write their
+# code once into the emitter instead of returning strings that get
+# concatenated again at every level of the token tree.
+#
+# write takes the span of the token writing the code, which only
+# SourceMapEmitter keeps.
+# Macro expansions are compiled into a new emitter from sub(), so that they can
+# be reused, and are then written with write_expansion. runs is what
+# expansion_runs() of the sub-emitter returned, span is the invocation and name
+# the name of the invoked macro.
+
+class CodeEmitter:
+    # Whether the emitter records where the code came from
+    MAPS_SOURCES = False
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, code, span=None):
+        self.chunks.append(code)
+
+    def sub(self):
+        return CodeEmitter()
+
+    def expansion_runs(self):
+        return None
+
+    def write_expansion(self, code, runs, span, name):
+        self.write(code)
+
+    def getvalue(self):
+        return "".join(self.chunks)
+
+# Used for code that is generated only for its side effects on the context,
+# such as ineffective loops and macro dry-runs
+class NullEmitter:
+    def write(self, code, span=None):
+        pass
+
+    def sub(self):
+        # The expansion still needs its code, to be reused elsewhere
+        return CodeEmitter()
+
+    def write_expansion(self, code, runs, span, name):
+        pass
+
+# Also collects a SourceMap of the code, see sourcemap.py
+# Frames are relative to the emitter, write_expansion puts the invocation in
+# front of the invocations of the frames of the expansion.
+class SourceMapEmitter(CodeEmitter):
+    MAPS_SOURCES = True
+
+    def __init__(self):
+        super().__init__()
+        self.source_map = SourceMap()
+
+    def write(self, code, span=None):
+        self.chunks.append(code)
+        self.source_map.add(len(code), ((), span))
+
+    def sub(self):
+        return SourceMapEmitter()
+
+    def expansion_runs(self):
+        return [(length, frame) for _, length, frame in self.source_map.runs()]
+
+    def write_expansion(self, code, runs, span, name):
+        self.chunks.append(code)
+        for length, (invocations, code_span) in runs:
+            self.source_map.add(length, (((span, name),) + invocations, code_span))
+
+# Writes postprocessed code straight to a file, as far as it is known
+class FileEmitter:
+    def __init__(self, file):
+        self.file = file
+        self.postproc = PostProc()
+
+    def write(self, code, span=None):
+        self.file.write(self.postproc.feed(code))
+
+    def sub(self):
+        return CodeEmitter()
+
+    def write_expansion(self, code, runs, span, name):
+        self.write(code)
+
+    def close(self):
+        self.file.write(self.postproc.finish())
@@ -1,8 +1,6 @@
 from add_n_gen import precomp_xyzk_list
 from tokens import *
 
-INIT_MACROS = {}
-
 PREGEN_SPAN = Span(BFPPFile("PREGENERATED", ""), 0, 0)
 
 def inc_by(n):
@@ -14,8 +12,8 @@ def inc_by(n):
     else:
         return Repetition(None, BFToken(PREGEN_SPAN, "-"), 256 - n)
 
-# Generate setN
-for i in range(256):
+# Builds the body of setN (or addN if do_set is False)
+def gen_body(i, do_set):
     (x, y, z, k) = precomp_xyzk_list[i]
 
     clear_tmp = TokenList(PREGEN_SPAN, [
@@ -28,52 +26,85 @@ for i in range(256):
         BFLoop(PREGEN_SPAN, True, BFToken(PREGEN_SPAN, "-")),
     ])
 
-    for do_set in [True, False]:
-        if y == z:
-            fn_body = TokenList(PREGEN_SPAN, [
-                # clear_tmp,
-                LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
-                inc_by(k + x),
-            ])
-        elif y == 0:
-            fn_body = TokenList(PREGEN_SPAN, [
-                # clear_tmp,
-                LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
-                inc_by(k),
-            ])
-        else:
-            fn_body = TokenList(PREGEN_SPAN, [
-                clear_tmp,
-                LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["tmp"])),
-                inc_by(x),
-                BFLoop(
-                    None,
-                    True,
-                    TokenList(PREGEN_SPAN, [
-                        LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
-                        inc_by(y),
-                        LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["tmp"])),
-                        inc_by(-z),
-                    ])),
-                LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
-                inc_by(k),
-            ])
-
-        if do_set:
-            fn_body.tokens.insert(0, clear_res)
-
-        args = LocDecBare(PREGEN_SPAN, [("res", "Byte"), ("tmp", "Byte")], (None, Path(PREGEN_SPAN, ["tmp"])))
-
-        if do_set:
-            fn = DeclareMacro(PREGEN_SPAN, "set" + str(i), args, fn_body)
-            INIT_MACROS["set" + str(i)] = fn
-        else:
-            fn = DeclareMacro(PREGEN_SPAN, "add" + str(i), args, fn_body)
-            INIT_MACROS["add" + str(i)] = fn
-
-            dec_n = 256 - i
-            if i == 0:
-                dec_n = 0
-            fn = DeclareMacro(PREGEN_SPAN, "dec" + str(dec_n), args, fn_body)
-            INIT_MACROS["dec" + str(dec_n)] = fn
+    if y == z:
+        fn_body = TokenList(PREGEN_SPAN, [
+            # clear_tmp,
+            LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
+            inc_by(k + x),
+        ])
+    elif y == 0:
+        fn_body = TokenList(PREGEN_SPAN, [
+            # clear_tmp,
+            LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
+            inc_by(k),
+        ])
+    else:
+        fn_body = TokenList(PREGEN_SPAN, [
+            clear_tmp,
+            LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["tmp"])),
+            inc_by(x),
+            BFLoop(
+                None,
+                True,
+                TokenList(PREGEN_SPAN, [
+                    LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
+                    inc_by(y),
+                    LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["tmp"])),
+                    inc_by(-z),
+                ])),
+            LocGoto(PREGEN_SPAN, Path(PREGEN_SPAN, ["res"])),
+            inc_by(k),
+        ])
+
+    if do_set:
+        fn_body.tokens.insert(0, clear_res)
+
+    return fn_body
+
+# Builds the builtin macro called name
+def gen_macro(name):
+    args = LocDecBare(PREGEN_SPAN, [("res", "Byte"), ("tmp", "Byte")], (None, Path(PREGEN_SPAN, ["tmp"])))
+
+    if name.startswith("set"):
+        fn_body = gen_body(int(name[3:]), True)
+    elif name.startswith("add"):
+        fn_body = gen_body(int(name[3:]), False)
+    else:
+        fn_body = gen_body((256 - int(name[3:])) % 256, False)
+
+    return DeclareMacro(PREGEN_SPAN, name, args, fn_body)
+
+BUILT_MACROS = {} # {name: DeclareMacro}, shared by all tables
+
+# The builtin macros are only built when they are first looked up.
+# Until then, their names are in the table with the value None, so checking if
+# a macro is defined or listing the defined macros works like for a normal dict.
+class MacroTable(dict):
+    def __getitem__(self, name):
+        fn = super().__getitem__(name)
+        if fn is None:
+            if name not in BUILT_MACROS:
+                BUILT_MACROS[name] = gen_macro(name)
+            fn = BUILT_MACROS[name]
+            self[name] = fn
+
+        return fn
+
+    def get(self, name, default=None):
+        if name in self:
+            return self[name]
+        return default
+
+    def copy(self):
+        return MacroTable(self)
+
+INIT_MACROS = MacroTable()
+
+for i in range(256):
+    INIT_MACROS["set" + str(i)] = None
+    INIT_MACROS["add" + str(i)] = None
 
+    dec_n = 256 - i
+    if i == 0:
+        dec_n = 0
+    INIT_MACROS["dec" + str(dec_n)] = None
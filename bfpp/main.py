@@ -1,33 +1,63 @@
-from sys import argv
-from parse import parse
+import argparse
+from parse import parse, CACHE_DIR
 from context import State
-from postproc import postproc
+from postproc import PostProc, postproc
+from emit import CodeEmitter, SourceMapEmitter, FileEmitter
 from init_macros import INIT_MACROS
 from init_types import INIT_TYPES
 
-def compile_path_to_str(path):
+# If out_file is given, the code is streamed into it while compiling instead
+# of being returned. Note that if compilation fails, out_file may already
+# contain part of the code.
+# With jobs > 1, macro definitions are dry-run in that many processes.
+# If included is given, the paths of all included files are added to it.
+# If source_map is given, the SourceMap of the returned code is added to it.
+# That is only supported without out_file.
+def compile_path_to_str(path, out_file=None, jobs=1, use_cache=True, included=None, source_map=None):
     code = open(path, "r").read()
-    tokens = parse(path, code)
+    tokens = parse(path, code, included, use_cache)
 
     ctx = State()
-    ctx.macros = INIT_MACROS
-    ctx.types = INIT_TYPES
+    ctx.macros = INIT_MACROS.copy()
+    ctx.types = dict(INIT_TYPES)
+    ctx.jobs = jobs
 
-    res = tokens.into_bf(ctx)
-
-    if ctx.n_errors == 0:
-        return postproc(res)
+    if source_map is not None:
+        out = SourceMapEmitter()
+    elif out_file is None:
+        out = CodeEmitter()
     else:
+        out = FileEmitter(out_file)
+
+    tokens.compile(ctx, out)
+
+    if ctx.n_errors != 0:
         print("Compilation failed due to", ctx.n_errors, "errors")
-        exit()
+        exit(1)
 
-if __name__ == "__main__":
-    if len(argv) == 2:
-        # Read file
-        path = argv[1]
+    if source_map is not None:
+        proc = PostProc(track=True)
+        code = proc.feed(out.getvalue()) + proc.finish()
+        source_map.add_selected(out.source_map, proc.kept)
+        return code
+    elif out_file is None:
+        return postproc(out.getvalue())
     else:
-        print("Please provide a file!")
-        exit()
+        out.close()
 
-    compiled = compile_path_to_str(path)
-    print(compiled)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile bfpp to bf")
+    parser.add_argument("file", help="File to compile")
+    parser.add_argument("out", nargs="?", help="Write the code to this file instead of printing it")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Dry-run macro definitions in this many processes")
+    parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="always parse every file, without using " + CACHE_DIR)
+
+    args = parser.parse_args()
+
+    if args.out is not None:
+        # Stream the code into the output file
+        with open(args.out, "w") as f:
+            compile_path_to_str(args.file, f, args.jobs, args.use_cache)
+    else:
+        compiled = compile_path_to_str(args.file, jobs=args.jobs, use_cache=args.use_cache)
+        print(compiled)
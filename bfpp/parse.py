@@ -1,4 +1,7 @@
 import os
+import hashlib
+import pickle
+import lark
 from tokens import *
 from lark import Lark, Transformer, v_args
 from bfppfile import BFPPFile, Span
@@ -93,12 +96,37 @@ COMMENT: "/*" /(.|\n)*?/ "*/"
 
 parser = Lark(grammar, start="main", propagate_positions=True)
 
-INCLUDED_FILES = set()
+# Parsed files are pickled into CACHE_DIR, keyed by their name and contents and
+# by CACHE_VERSION. Entries made by another grammar, Lark version or token
+# layout are never looked up, because these are hashed into CACHE_VERSION too.
+CACHE_DIR = ".bfpp_cache"
+
+def get_cache_version():
+    version = hashlib.sha256()
+    version.update(grammar.encode())
+    version.update(lark.__version__.encode())
+
+    # The pickled token trees depend on how these modules define their classes
+    here = os.path.dirname(os.path.abspath(__file__))
+    for name in ["parse.py", "tokens.py", "bfppfile.py", "include.py"]:
+        with open(os.path.join(here, name), "rb") as f:
+            version.update(f.read())
+
+    return version.hexdigest()
+
+CACHE_VERSION = get_cache_version()
 
 class ParseTransformer(Transformer):
     def __init__(self, bfile):
         self.bfile = bfile
 
+        # (empty TokenList, StdLibPath or LocalPath) for every #include, in
+        # the order they appear. They are filled in by parse, as which files
+        # still have to be included depends on what was included before. The
+        # paths are only resolved there too, since these are cached, and the
+        # stdlib is wherever the bfpp reading the cache is.
+        self.includes = []
+
     def meta2span(self, meta):
         return Span(self.bfile, meta.start_pos, meta.end_pos)
 
@@ -195,14 +223,10 @@ class ParseTransformer(Transformer):
 
     @v_args(meta=True)
     def include(self, args, meta):
-        path = args[0].find_path()
-
-        if path in INCLUDED_FILES:
-            return TokenList(self.meta2span(meta), [])
+        placeholder = TokenList(self.meta2span(meta), [])
+        self.includes.append((placeholder, args[0]))
 
-        INCLUDED_FILES.add(path)
-
-        return parse(path, open(path).read())
+        return placeholder
 
     def std_path(self, args):
         return StdLibPath(args[0])
@@ -226,11 +250,55 @@ class ParseTransformer(Transformer):
     def debug(self, args, meta):
         return Debug(self.meta2span(meta))
 
-def parse(filename, code):
+# Returns the tokens of a single file and its includes, see ParseTransformer
+def parse_file(filename, code, use_cache):
+    key = hashlib.sha256()
+    key.update(repr((CACHE_VERSION, filename)).encode())
+    key.update(code.encode())
+    cache_path = os.path.join(CACHE_DIR, key.hexdigest())
+
+    if use_cache:
+        try:
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+        except Exception:
+            # Missing or unreadable, just parse again
+            pass
+
     bfile = BFPPFile(filename, code)
 
     parsed = parser.parse(code)
-    tokens = ParseTransformer(bfile).transform(parsed)
+    transformer = ParseTransformer(bfile)
+    tokens = transformer.transform(parsed)
+    entry = (tokens, transformer.includes)
+
+    if use_cache:
+        try:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(entry, f)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+
+    return entry
+
+# Each file is included at most once. included is the set of paths that were
+# included so far and is updated with the ones included by this file.
+def parse(filename, code, included=None, use_cache=True):
+    if included is None:
+        included = set()
+
+    tokens, includes = parse_file(filename, code, use_cache)
+
+    for placeholder, include_path in includes:
+        path = include_path.find_path()
+        if path in included:
+            continue
+
+        included.add(path)
+        placeholder.tokens = [parse(path, open(path).read(), included, use_cache)]
 
     return tokens
 
@@ -1,9 +1,96 @@
+INVERSE = {"+": "-", "-": "+", "<": ">", ">": "<"}
+
+# Cleans up generated code in a single pass:
+#  * +- and <> cancel out, also when they meet after other runs have cancelled
+#  * Loops that start on a cell known to be zero are removed. That is any cell
+#    before the first +, - or , and the cell a loop just ended on.
+# Code can be fed in parts, and everything up to the last character that can't
+# be cancelled out anymore is returned right away.
+# With track, kept gets the offset into all the code fed so far of every
+# character that was returned, for source maps.
+class PostProc:
+    def __init__(self, track=False):
+        self.stack = []
+        # (zero, untouched, offset) before each character in stack
+        self.states = []
+
+        self.track = track
+        self.kept = []
+        # Number of characters fed so far
+        self.fed = 0
+
+        # Whether the current cell is known to be zero
+        self.zero = True
+        # Whether no cell has been changed yet
+        self.untouched = True
+
+        # Nesting depth inside a removed loop
+        self.skipping = 0
+
+    def feed(self, code):
+        stack = self.stack
+        states = self.states
+
+        for offset, ch in enumerate(code, self.fed):
+            if self.skipping:
+                if ch == "[":
+                    self.skipping += 1
+                elif ch == "]":
+                    self.skipping -= 1
+                continue
+
+            if ch in INVERSE:
+                if stack and stack[-1] == INVERSE[ch]:
+                    stack.pop()
+                    self.zero, self.untouched, _ = states.pop()
+                    continue
+
+                stack.append(ch)
+                states.append((self.zero, self.untouched, offset))
+
+                if ch in "<>":
+                    self.zero = self.untouched
+                else:
+                    self.zero = self.untouched = False
+                continue
+
+            if ch == "[" and self.zero:
+                self.skipping = 1
+                continue
+
+            stack.append(ch)
+            states.append((self.zero, self.untouched, offset))
+
+            if ch == "[":
+                # The body can run several times, so nothing is known in it
+                self.zero = self.untouched = False
+            elif ch == "]":
+                self.zero = True
+            elif ch == ",":
+                self.zero = self.untouched = False
+
+        # Nothing before the last other character can be cancelled anymore
+        done = len(stack)
+        while done > 0 and stack[done - 1] in INVERSE:
+            done -= 1
+
+        self.fed += len(code)
+
+        res = "".join(stack[:done])
+        if self.track:
+            self.kept += [state[2] for state in states[:done]]
+        del stack[:done]
+        del states[:done]
+        return res
+
+    def finish(self):
+        res = "".join(self.stack)
+        if self.track:
+            self.kept += [state[2] for state in self.states]
+        self.stack = []
+        self.states = []
+        return res
+
 def postproc(code):
-    while True:
-        l = len(code)
-        code = code.replace("+-", "")
-        code = code.replace("-+", "")
-        code = code.replace("<>", "")
-        code = code.replace("><", "")
-        if l == len(code):
-            return code
+    proc = PostProc()
+    return proc.feed(code) + proc.finish()
@@ -0,0 +1,104 @@
+import bisect
+from array import array
+from itertools import accumulate
+
+# Maps every character of the generated code to where it came from.
+#
+# A frame is (invocations, span). invocations has (span of the `run`, name of
+# the macro) for every macro invocation the code is in, outermost first, and
+# span is the token that wrote the code. Frames are stored once
+# in frames, and the code is covered by runs of characters with the same frame,
+# run-length encoded into lengths and frame_ids.
+class SourceMap:
+    def __init__(self):
+        self.frames = []
+        self.frame_ids = array("L")
+        self.lengths = array("L")
+
+        # {frame: index into frames}
+        self.frame_index = {}
+        # Offsets where each run ends, for find
+        self.ends = None
+
+    def add(self, length, frame):
+        if length == 0:
+            return
+
+        frame_id = self.frame_index.get(frame)
+        if frame_id is None:
+            frame_id = len(self.frames)
+            self.frames.append(frame)
+            self.frame_index[frame] = frame_id
+
+        if len(self.frame_ids) > 0 and self.frame_ids[-1] == frame_id:
+            self.lengths[-1] += length
+        else:
+            self.frame_ids.append(frame_id)
+            self.lengths.append(length)
+        self.ends = None
+
+    # Returns the frame of the character at offset, or None past the end
+    def find(self, offset):
+        if self.ends is None:
+            self.ends = array("Q", accumulate(self.lengths))
+
+        run = bisect.bisect_right(self.ends, offset)
+        if run == len(self.ends):
+            return None
+        return self.frames[self.frame_ids[run]]
+
+    # Yields the index into frames for each of offsets, which have to be sorted,
+    # or None past the end. Faster than find for many offsets.
+    def frame_ids_at(self, offsets):
+        run, end = -1, 0
+        for offset in offsets:
+            while offset >= end and run + 1 < len(self.lengths):
+                run += 1
+                end += self.lengths[run]
+            yield self.frame_ids[run] if offset < end else None
+
+    # Yields (start offset, length, frame) for every run
+    def runs(self):
+        at = 0
+        for frame_id, length in zip(self.frame_ids, self.lengths):
+            yield at, length, self.frames[frame_id]
+            at += length
+
+    # Adds the characters of the code mapped by source at kept, a sorted list of
+    # offsets into that code
+    def add_selected(self, source, kept):
+        runs = source.runs()
+        start, length, frame = 0, 0, None
+        count = 0
+        for offset in kept:
+            if offset >= start + length:
+                self.add(count, frame)
+                count = 0
+                start, length, frame = next(runs)
+                while offset >= start + length:
+                    start, length, frame = next(runs)
+            count += 1
+        self.add(count, frame)
+
+    def __getstate__(self):
+        # frame_index and ends are rebuilt when needed
+        return {"frames": self.frames, "frame_ids": self.frame_ids, "lengths": self.lengths}
+
+    def __setstate__(self, state):
+        self.frames = state["frames"]
+        self.frame_ids = state["frame_ids"]
+        self.lengths = state["lengths"]
+        self.frame_index = {frame: i for i, frame in enumerate(self.frames)}
+        self.ends = None
+
+# The file of the spans of built-in macros, see PREGEN_SPAN in init_macros.py
+PREGENERATED_FILE = "PREGENERATED"
+
+# Returns (file name, line) of the start of a span, with lines counted from 1,
+# or None for code generated by the compiler itself
+def span_line(span):
+    if span is None or span.bfile.name == PREGENERATED_FILE:
+        return None
+    line, _ = span.bfile.line_offset_for_pos(span.start)
+    return span.bfile.name, line + 1
+
@@ -5,17 +5,26 @@ from bfppfile import Span, BFPPFile
 from error import *
 from context import State, StateDelta
 from cell_action import *
+from emit import CodeEmitter, NullEmitter
 import bfpp_types
+import dryrun
 
 class BFPPToken(ABC):
     @abstractmethod
     def __init__(self, span):
         self.span = span
 
+    # Writes the code for this token into the emitter `out`, updates ctx to
+    # the state after the token and returns the delta from the state before
     @abstractmethod
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         pass
 
+    def into_bf(self, ctx):
+        out = CodeEmitter()
+        self.compile(ctx, out)
+        return out.getvalue()
+
     @abstractmethod
     def get_delta(self, ctx):
         pass
@@ -24,14 +33,15 @@ class Debug(BFPPToken):
     def __init__(self, span):
         super(Debug, self).__init__(span)
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         print("Debug at")
         print("\n".join(self.span.show_ascii_art()))
         print("Info:")
         print("    ctx =", ctx)
         print()
 
-        return "#"
+        out.write("#", self.span)
+        return StateDelta()
 
     def get_delta(self, ctx):
         return StateDelta()
@@ -49,8 +59,11 @@ class BFToken(BFPPToken):
 
         self.token = token
 
-    def into_bf(self, ctx):
-        return self.token
+    def compile(self, ctx, out):
+        out.write(self.token, self.span)
+        delta = self.get_delta(ctx)
+        ctx.apply_delta(delta)
+        return delta
 
     def get_delta(self, ctx):
         if self.token == ">":
@@ -82,14 +95,16 @@ class TokenList(BFPPToken):
         super().__init__(span)
         self.tokens = tokens
 
-    def into_bf(self, ctx):
-        res = ""
-        for x in self.tokens:
-            res += x.into_bf(ctx)
-            delta = x.get_delta(ctx.silent())
-            ctx.apply_delta(delta)
+    def compile(self, ctx, out):
+        tokens = self.tokens
+        if ctx.jobs > 1 and not ctx.quiet:
+            tokens = MacroBatch.group(tokens)
 
-        return res
+        total_delta = StateDelta()
+        for x in tokens:
+            total_delta = total_delta @ x.compile(ctx, out)
+
+        return total_delta
 
     def get_delta(self, ctx):
         total_delta = StateDelta()
@@ -112,8 +127,14 @@ class BFLoop(BFPPToken):
         super().__init__(span)
         self.inner = inner
         self.is_stable = is_stable
+        # The closing ], so that it maps to its own line in source maps.
+        # Generated loops have no span.
+        if span is not None:
+            self.end_span = Span(span.bfile, span.end - 1, span.end)
+        else:
+            self.end_span = None
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         is_effective = ctx.cell_values[ctx.ptr] != 0
 
         if not ctx.quiet and not is_effective:
@@ -129,12 +150,18 @@ class BFLoop(BFPPToken):
 
         ctx.apply_delta(preloop)
 
-        code = "[" + self.inner.into_bf(ctx) + "]"
         if is_effective:
-            return code
+            out.write("[", self.span)
+            self.inner.compile(ctx, out)
+            out.write("]", self.end_span)
         else:
-            # Maybe evaluate inner.into_bf(ctx) to check for warnings?
-            return ""
+            # The inner code is still generated for its effects on ctx
+            self.inner.compile(ctx, NullEmitter())
+
+        # preloop already covers everything the inner code might have done
+        delta = preloop @ StateDelta.do_action(SetTo(self.span, 0))
+        ctx.apply_delta(delta)
+        return delta
 
     def get_inner_delta_rep(self, ctx):
         inner_delta = self.inner.get_delta(ctx)
@@ -184,19 +211,18 @@ class Repetition(BFPPToken):
     def __repr__(self):
         return "Repetition(" + repr(self.inner) + ") * " + repr(self.count)
 
-    def into_bf(self, ctx):
-        res = ""
+    def compile(self, ctx, out):
+        total = StateDelta()
         for i in range(self.count):
-            res += self.inner.into_bf(ctx)
-            ctx.apply_delta(self.inner.get_delta(ctx.silent()))
-
-        return res
+            total @= self.inner.compile(ctx, out)
+        return total
 
     def get_delta(self, ctx):
         total = StateDelta()
         for i in range(self.count):
-            total @= self.inner.get_delta(ctx)
-            ctx.apply_delta(self.inner.get_delta(ctx))
+            delta = self.inner.get_delta(ctx)
+            ctx = ctx.with_delta_applied(delta)
+            total @= delta
         return total
 
 class LocDec(BFPPToken):
@@ -210,14 +236,18 @@ class LocDec(BFPPToken):
     def __str__(self):
         return "declare " + str(self.bare)
 
-    def into_bf(self, ctx):
-        self.get_delta(ctx)
-        return ""
+    def compile(self, ctx, out):
+        return self.get_delta(ctx)
 
     def get_delta(self, ctx):
+        named_locations = ctx.named_locations.copy()
+        name_type_names = ctx.name_type_names.copy()
         for name, (idx, type_name) in self.bare.get_var_offsets_and_type_names(ctx).items():
-            ctx.named_locations[name] = idx
-            ctx.name_type_names[name] = type_name
+            named_locations[name] = idx
+            name_type_names[name] = type_name
+
+        ctx.named_locations = named_locations
+        ctx.name_type_names = name_type_names
 
         return StateDelta()
 
@@ -233,13 +263,16 @@ class LocGoto(BFPPToken):
     def __repr__(self):
         return "LocGoto(" + repr(self.path) + ")"
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         delta = self.get_delta(ctx)
 
         if delta.ptr_delta > 0:
-            return ">" * delta.ptr_delta
+            out.write(">" * delta.ptr_delta, self.span)
         else:
-            return "<" * (-delta.ptr_delta)
+            out.write("<" * (-delta.ptr_delta), self.span)
+
+        ctx.apply_delta(delta)
+        return delta
 
     def get_delta(self, ctx):
         at, type_ = self.path.get_location_and_type(ctx)
@@ -264,15 +297,16 @@ class Undeclare(BFPPToken):
     def __repr__(self):
         return "Undeclare(" + repr(self.unvars) + ")"
 
-    def into_bf(self, ctx):
-        self.get_delta(ctx)
-        return ""
+    def compile(self, ctx, out):
+        return self.get_delta(ctx)
 
     def get_delta(self, ctx):
+        named_locations = ctx.named_locations.copy()
+        name_type_names = ctx.name_type_names.copy()
         for unvar in self.unvars:
-            if unvar in ctx.named_locations and unvar in ctx.name_type_names:
-                del ctx.named_locations[unvar]
-                del ctx.name_type_names[unvar]
+            if unvar in named_locations and unvar in name_type_names:
+                del named_locations[unvar]
+                del name_type_names[unvar]
             else:
                 if not ctx.quiet:
                     er = MemNotFoundError(
@@ -283,6 +317,9 @@ class Undeclare(BFPPToken):
                     er.show()
                     ctx.n_errors += 1
 
+        ctx.named_locations = named_locations
+        ctx.name_type_names = name_type_names
+
         return StateDelta()
 
 class AssumeStable(BFPPToken):
@@ -296,11 +333,20 @@ class AssumeStable(BFPPToken):
     def __repr__(self):
         return "AssumeStable(content=" + repr(self.content) + ")"
 
-    def into_bf(self, ctx):
-        inner_code = self.content.into_bf(ctx)
+    def compile(self, ctx, out):
+        # The content is compiled in its own state, as the pointer is only
+        # known again once it is done
+        content_ctx = ctx.copy()
+        inner_delta = self.content.compile(content_ctx, out)
+        ctx.n_errors = content_ctx.n_errors
+
+        inner_delta.ptr_delta = 0
+        inner_delta.ptr_id_delta = 0
+
+        ctx.apply_delta(inner_delta)
         # For safety, assume all cells were modified
         ctx.cell_values = defaultdict(lambda: None)
-        return inner_code
+        return inner_delta
 
     def get_delta(self, ctx):
         inner_delta = self.content.get_delta(ctx)
@@ -324,20 +370,30 @@ class DeclareMacro(BFPPToken):
         return "Define(" + self.name + "," + repr(
             self.args) + "," + repr(self.content) + ")"
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         if not ctx.quiet and self.name in ctx.macros.keys():
-            er = Error(
-                self.span,
-                msg="macro " + str(self.name) + " is already defined"
-            )
-            er.show()
-            ctx.n_errors += 1
-            return ""
+            self.show_already_defined(ctx)
+            return StateDelta()
+
+        self.dry_run(ctx, ctx.macros)
+
+        ctx.macros[self.name] = self
+        return StateDelta()
+
+    def show_already_defined(self, ctx):
+        er = Error(
+            self.span,
+            msg="macro " + str(self.name) + " is already defined"
+        )
+        er.show()
+        ctx.n_errors += 1
 
-        # Dry-run macro to check for errors/warnings
+    # Dry-run macro to check for errors/warnings
+    def dry_run(self, ctx, macros):
         dry_ctx = State()
-        dry_ctx.macros = ctx.macros
+        dry_ctx.macros = macros
         dry_ctx.types = ctx.types
+        dry_ctx.expansions = ctx.expansions
         # Make sure all values are unknown
         dry_ctx.cell_values = defaultdict(lambda: None)
         dry_ctx.quiet = ctx.quiet
@@ -347,10 +403,79 @@ class DeclareMacro(BFPPToken):
             dry_ctx.named_locations[arg] = at
             dry_ctx.name_type_names[arg] = type_name
 
-        _ = self.content.into_bf(dry_ctx)
+        self.content.compile(dry_ctx, NullEmitter())
 
-        ctx.macros[self.name] = self
-        return ""
+    def get_delta(self, ctx):
+        return StateDelta()
+
+# Consecutive macro definitions, whose dry-runs are done in a process pool.
+# Their messages are shown in the same order as if they were defined one by one.
+class MacroBatch(BFPPToken):
+    def __init__(self, span, macros):
+        super().__init__(span)
+        self.macros = macros
+
+    def __str__(self):
+        return ";".join(map(str, self.macros))
+
+    def __repr__(self):
+        return "MacroBatch(" + ",".join(map(repr, self.macros)) + ")"
+
+    # Replaces runs of at least dryrun.MIN_BATCH macro definitions in tokens
+    @staticmethod
+    def group(tokens):
+        res = []
+        run = []
+        for x in tokens + [None]:
+            if isinstance(x, DeclareMacro):
+                run.append(x)
+                continue
+
+            if len(run) >= dryrun.MIN_BATCH:
+                span = Span(run[0].span.bfile, run[0].span.start, run[-1].span.end)
+                res.append(MacroBatch(span, run))
+            else:
+                res.extend(run)
+            run = []
+
+            if x is not None:
+                res.append(x)
+
+        return res
+
+    def compile(self, ctx, out):
+        # Define all macros first, so the workers can see the ones before theirs
+        n_macros = len(ctx.macros)
+        jobs = []
+        for macro in self.macros:
+            if macro.name in ctx.macros.keys():
+                jobs.append((macro, None))
+            else:
+                jobs.append((macro, len(ctx.macros)))
+                ctx.macros[macro.name] = macro
+
+        printed = dryrun.dry_run_all(ctx, [job for job in jobs if job[1] is not None])
+
+        if printed is None:
+            # Some macro defines things while being dry-run, so do it the slow way
+            for macro, _ in jobs:
+                if ctx.macros.get(macro.name) is macro:
+                    del ctx.macros[macro.name]
+            assert len(ctx.macros) == n_macros
+
+            for macro in self.macros:
+                macro.compile(ctx, out)
+
+            return StateDelta()
+
+        printed = iter(printed)
+        for macro, n_macros in jobs:
+            if n_macros is None:
+                macro.show_already_defined(ctx)
+            else:
+                print(next(printed), end="")
+
+        return StateDelta()
 
     def get_delta(self, ctx):
         return StateDelta()
@@ -385,6 +510,7 @@ class InvokeMacro(BFPPToken):
         sub_ctx = State()
         sub_ctx.macros = ctx.macros
         sub_ctx.types = ctx.types
+        sub_ctx.expansions = ctx.expansions
         sub_ctx.ptr = ctx.ptr
         sub_ctx.cell_values = ctx.cell_values
         sub_ctx.quiet = True
@@ -429,16 +555,81 @@ class InvokeMacro(BFPPToken):
 
         return fn_with_goto, sub_ctx
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         f, sub_ctx = self.get_code_and_subctx(ctx)
 
-        return f.into_bf(sub_ctx)
+        if self.name in ctx.macros.keys():
+            code, runs, delta = self.expand(ctx, f, sub_ctx, out)
+            out.write_expansion(code, runs, self.span, self.name)
+        else:
+            delta = f.compile(sub_ctx, out)
+
+        ctx.apply_delta(delta)
+        return delta
+
+    # Compiles the macro, reusing an earlier expansion if possible.
+    # The code only depends on the macro, where the arguments are relative to
+    # the pointer and the values of the cells that are checked by loops. Those
+    # cells are all visited by the generated code, so an expansion can be reused
+    # when the cells it visited have the same values as when it was generated.
+    # Returns the code, its source map runs from the emitter out is about to be
+    # written to (see emit.py) and the delta.
+    def expand(self, ctx, f, sub_ctx, out):
+        args = tuple(
+            (name, at - ctx.ptr, sub_ctx.name_type_names[name])
+            for name, at in sub_ctx.named_locations.items()
+        )
+        # New macros and types could change the meaning of the body. Expansions
+        # generated without a source map can't be used where one is needed.
+        code_out = out.sub()
+        key = (ctx.macros[self.name], args, len(ctx.macros), len(ctx.types), code_out.MAPS_SOURCES)
+
+        expansions = ctx.expansions.setdefault(key, [])
+        for offsets, values, code, runs, delta in expansions:
+            if values == tuple(ctx.cell_values[ctx.ptr + at] for at in offsets):
+                return code, runs, delta.copy()
+
+        delta = f.compile(sub_ctx, code_out)
+        code = code_out.getvalue()
+        runs = code_out.expansion_runs()
+
+        if len(expansions) < MAX_EXPANSIONS:
+            offsets = visited_offsets(code)
+            values = tuple(ctx.cell_values[ctx.ptr + at] for at in offsets)
+            expansions.append((offsets, values, code, runs, delta.copy()))
+
+        return code, runs, delta
 
     def get_delta(self, ctx):
         f, sub_ctx = self.get_code_and_subctx(ctx)
 
         return f.get_delta(sub_ctx)
 
+# Expansions kept per macro and argument layout
+MAX_EXPANSIONS = 16
+
+# Offsets from the start that the pointer visits in code. Loops are assumed to
+# return to where they started, like the analysis does for stable loops.
+# After other loops the cell values are unknown, so cells visited from there on
+# don't matter.
+def visited_offsets(code):
+    at = 0
+    visited = {0}
+    loop_starts = []
+    for ch in code:
+        if ch == ">":
+            at += 1
+            visited.add(at)
+        elif ch == "<":
+            at -= 1
+            visited.add(at)
+        elif ch == "[":
+            loop_starts.append(at)
+        elif ch == "]":
+            at = loop_starts.pop()
+
+    return tuple(sorted(visited))
+
 class TypeDec(BFPPToken):
     def __init__(self, span, typename, fields):
         super().__init__(span)
@@ -452,15 +643,14 @@ class TypeDec(BFPPToken):
     def __repr__(self):
         return "TypeDec(typename={}, fields={})".format(self.typename, self.fields)
 
-    def into_bf(self, ctx):
+    def compile(self, ctx, out):
         if self.typename in ctx.types.keys():
             # Error?
             pass
 
         type_ = bfpp_types.Struct(self.fields)
         ctx.types[self.typename] = type_
-
-        return ""
+        return StateDelta()
 
     def get_delta(self, ctx):
         return StateDelta()
@@ -1,4 +1,7 @@
+import os
 import sys
+import argparse
+from array import array
 
 divs_mod_256 = {}
 
@@ -30,7 +33,94 @@ def smallest256(x):
         return x - 256
 
 
+# Precomputed results of search_val_from for every (from, to) pair, made by
+# gen_tables.py. Bump TABLE_VERSION when the search changes.
+TABLE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "transitions.bin")
+TABLE_MAGIC = b"BFTR"
+TABLE_VERSION = 1
+
+
+def load_table(path=TABLE_PATH):
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    header = TABLE_MAGIC + bytes([TABLE_VERSION])
+    if not data.startswith(header):
+        return None
+
+    table = array("b")
+    table.frombytes(data[len(header):])
+    if len(table) != 256 * 256 * 4:
+        return None
+
+    return table
+
+
+def write_table(table, path=TABLE_PATH):
+    with open(path, "wb") as f:
+        f.write(TABLE_MAGIC + bytes([TABLE_VERSION]))
+        f.write(table.tobytes())
+
+
+# Gives the same results as search_val_from for all pairs at once. Instead of
+# trying every (cur_change, mult, div) for every target, only the cheapest way
+# to reach each intermediate value is kept, with the same tie-breaking.
+def gen_table():
+    table = array("b", bytes(256 * 256 * 4))
+
+    for current_val in range(256):
+        # {res_val: (score, order, (cur_change, mult, div))}
+        best_to_res = {}
+        order = 0
+        for cur_change in range(-15, 16):
+            for mult in range(-15, 16):
+                for div in range(-15, 16):
+                    if div == 0 or div not in divs_mod_256:
+                        continue
+
+                    order += 1
+                    res_val = (current_val +
+                               cur_change) * mult * divs_mod_256[div] % 256
+
+                    score = abs256(cur_change) + abs256(mult) + abs256(div)
+                    if mult == 0:
+                        score -= 1
+                    if mult == 1:
+                        score -= 6
+
+                    if res_val not in best_to_res or score <= best_to_res[res_val][0]:
+                        best_to_res[res_val] = (score, order, (cur_change, mult, div))
+
+        candidates = [(res_val, score, order, ops) for res_val, (score, order, ops) in best_to_res.items()]
+        for to in range(256):
+            best = None
+            for res_val, score, order, ops in candidates:
+                key = (score + abs256(to - res_val), -order)
+                if best is None or key < best[0]:
+                    best = (key, res_val, ops)
+
+            _, res_val, (cur_change, mult, div) = best
+            i = (current_val * 256 + to) * 4
+            table[i:i + 4] = array("b", [cur_change, mult, div, smallest256(to - res_val)])
+
+    return table
+
+
+TABLE = load_table()
+
+
 def go_to_val_from(current_val, to):
+    if TABLE is not None:
+        i = (current_val % 256 * 256 + to % 256) * 4
+        return tuple(TABLE[i:i + 4])
+
+    return search_val_from(current_val, to)
+
+
+def search_val_from(current_val, to):
     best = None
     best_score = 1e10
 
@@ -78,10 +168,156 @@ def gen_code(cur_change, mult, div, post_change, cur_left):
         return bf_add(cur_change) + "[<" + bf_add(mult) + ">" + bf_add(
             -div) + "]<" + bf_add(post_change)
 
+# Code for going from cur_val to the value to, and whether the value is then in
+# the left cell of the two
+def greedy_step(cur_val, to, cur_left):
+    c_ch, m, div, p_ch = go_to_val_from(cur_val, to)
+
+    if m == 0:
+        out = "[-]" + bf_add(p_ch)
+    elif m == div:
+        out = bf_add(c_ch + p_ch)
+    else:
+        out = gen_code(c_ch, m, div, p_ch, cur_left)
+        cur_left = not cur_left
+
+    return out, cur_left
+
+
+def gen_greedy(text):
+    cur_val = 0
+    cur_left = True
+
+    out = ""
+    for ch in text:
+        code, cur_left = greedy_step(cur_val, ord(ch), cur_left)
+        out += code + "."
+        cur_val = ord(ch)
+
+    return out
+
+
+def bf_move(from_, to):
+    if to < from_:
+        return "<" * (from_ - to)
+    else:
+        return ">" * (to - from_)
+
+
+# The ways to print a character, given (values of the cells, pointer).
+# Each is (kind, args, cost), cost being the length of the code.
+#   add: go to a cell and add to it
+#   clear: go to a cell, clear it and add to it
+#   loop: go to a cell and move it into an empty cell with gen_code's loop
+def plan_steps(vals, at, to):
+    for cell, val in enumerate(vals):
+        move = abs(cell - at)
+
+        change = smallest256(to - val)
+        yield ("add", (at, cell, change), move + abs(change) + 1)
+
+        if val != 0:
+            change = smallest256(to)
+            yield ("clear", (at, cell, change), move + 3 + abs(change) + 1)
+
+        c_ch, m, div, p_ch = go_to_val_from(val, to)
+        if m == 0 or m == div:
+            continue
+
+        for empty, empty_val in enumerate(vals):
+            if empty == cell or empty_val != 0:
+                continue
+
+            dist = abs(empty - cell)
+            cost = move + abs(c_ch) + 2 + 3 * dist + abs(m) + div + abs(p_ch) + 1
+            yield ("loop", (at, cell, empty, c_ch, m, div, p_ch), cost)
+
+
+def step_code(kind, args):
+    if kind == "add":
+        at, cell, change = args
+        return bf_move(at, cell) + bf_add(change) + "."
+    if kind == "clear":
+        at, cell, change = args
+        return bf_move(at, cell) + "[-]" + bf_add(change) + "."
+
+    at, cell, empty, c_ch, m, div, p_ch = args
+    return (bf_move(at, cell) + bf_add(c_ch) + "[" + bf_move(cell, empty) +
+            bf_add(m) + bf_move(empty, cell) + bf_add(-div) + "]" +
+            bf_move(cell, empty) + bf_add(p_ch) + ".")
+
+
+def after_step(vals, kind, args, to):
+    vals = list(vals)
+    if kind == "loop":
+        at, cell, empty = args[:3]
+        vals[cell] = 0
+        vals[empty] = to % 256
+        return tuple(vals), empty
+
+    at, cell = args[:2]
+    vals[cell] = to % 256
+    return tuple(vals), cell
+
+
+# Plans the code for the whole text with a beam search over n_cells cells,
+# starting at the leftmost one. All cells have to be zero at the start.
+# Keeps the beam_width shortest codes for each prefix, one for every
+# (values of the cells, pointer). Falls back to gen_greedy if that is shorter.
+def gen_planned(text, n_cells=4, beam_width=32):
+    # {(vals, at): (cost, steps)}, steps being a linked list (kind, args, prev)
+    beam = {((0,) * n_cells, 0): (0, None)}
+
+    for ch in text:
+        to = ord(ch)
+        next_beam = {}
+        for (vals, at), (cost, steps) in beam.items():
+            for kind, args, step_cost in plan_steps(vals, at, to):
+                state = after_step(vals, kind, args, to)
+                new_cost = cost + step_cost
+                if state not in next_beam or new_cost < next_beam[state][0]:
+                    next_beam[state] = (new_cost, (kind, args, steps))
+
+        best = sorted(next_beam.items(), key=lambda item: item[1][0])[:beam_width]
+        beam = dict(best)
+
+    cost, steps = min(beam.values(), key=lambda item: item[0])
+
+    codes = []
+    while steps is not None:
+        kind, args, steps = steps
+        codes.append(step_code(kind, args))
+    out = "".join(reversed(codes))
+
+    greedy = gen_greedy(text)
+    if len(greedy) <= len(out):
+        return greedy
+
+    return out
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate bf code printing a string")
+    parser.add_argument("string", nargs="?", help="String to print. If not given, lines are read from stdin")
+    parser.add_argument("-p", "--plan", action="store_true", help="Plan the whole string at once, using several cells")
+    parser.add_argument("--cells", type=int, default=4, help="Number of cells used by --plan")
+    parser.add_argument("--beam", type=int, default=32, help="Number of candidates kept for every character by --plan")
+
+    args = parser.parse_args()
+
+    if args.plan:
+        if args.string is not None:
+            text = args.string
+        else:
+            text = sys.stdin.read()
+            if text.endswith("\n"):
+                text = text[:-1]
+
+        print(gen_planned(text, args.cells, args.beam))
+        exit()
+
     continue_after_end = True
-    if len(sys.argv) == 2:
-        wanted_string = sys.argv[1]
+    if args.string is not None:
+        wanted_string = args.string
         continue_after_end = False
     else:
         wanted_string = input()
@@ -98,13 +334,7 @@ if __name__ == "__main__":
         c_ch, m, div, p_ch = go_to_val_from(cur_val, n)
         print(cur_val, "to", n, "=", chr(n), "->", c_ch, m, div, p_ch, file=sys.stderr)
 
-        if m == 0:
-            out = "[-]" + bf_add(p_ch)
-        elif m == div:
-            out = bf_add(c_ch + p_ch)
-        else:
-            out = gen_code(c_ch, m, div, p_ch, cur_left)
-            cur_left = not cur_left
+        out, cur_left = greedy_step(cur_val, n, cur_left)
 
         print(out + ".", end="", flush=True)
 
@@ -0,0 +1,95 @@
+import sys
+import random
+import argparse
+
+sys.path.append('bfpp')
+
+import gen_string
+import add_n_gen
+
+# Values closer to 0 than this are set by just adding to them, as the loop
+# needs more code than the score of find_xyzk counts
+DIRECT_LIMIT = 15
+
+# The cheapest x, y, z, k for every n, in the same way as add_n_gen.find_xyzk.
+# Only the cheapest (x, y, z) for each value of x * y / z is kept, with the
+# same tie-breaking as the full search.
+def gen_xyzk_list():
+    a = add_n_gen.abs_256
+    inv = add_n_gen.inv
+
+    best_to_prod = {} # {x * y / z: ((score, order), (x, y, z))}
+    order = 0
+    for x in range(256):
+        for y in range(256):
+            xy = x * y
+            score_xy = a(x) + a(y)
+            for z, inv_z in inv.items():
+                prod = xy * inv_z % 256
+                key = (score_xy + a(z), order)
+                order += 1
+
+                if prod not in best_to_prod or key < best_to_prod[prod][0]:
+                    best_to_prod[prod] = (key, (x, y, z))
+
+    res = []
+    for n in range(256):
+        if add_n_gen.abs_256(n) < DIRECT_LIMIT:
+            res.append((0, 0, 1, n))
+            continue
+
+        best = None
+        for prod, ((score, order), xyz) in best_to_prod.items():
+            k = (n - prod) % 256
+            key = (score + a(k), order)
+            if best is None or key < best[0]:
+                best = (key, xyz + (k,))
+
+        res.append(best[1])
+
+    return res
+
+def check(n_samples):
+    ok = True
+
+    table = gen_string.load_table()
+    if table is None:
+        print(gen_string.TABLE_PATH, "is missing or has the wrong version")
+        ok = False
+    elif table != gen_string.gen_table():
+        print(gen_string.TABLE_PATH, "does not match gen_string.gen_table()")
+        ok = False
+    else:
+        pairs = [(random.randrange(256), random.randrange(256)) for _ in range(n_samples)]
+        for from_, to in pairs:
+            if gen_string.go_to_val_from(from_, to) != gen_string.search_val_from(from_, to):
+                print("Wrong transition from", from_, "to", to)
+                ok = False
+
+    if gen_xyzk_list() != add_n_gen.precomp_xyzk_list:
+        print("add_n_gen.precomp_xyzk_list does not match gen_xyzk_list()")
+        ok = False
+    else:
+        far = [n for n in range(256) if add_n_gen.abs_256(n) >= DIRECT_LIMIT]
+        for n in random.sample(far, min(n_samples // 100, len(far))):
+            if add_n_gen.find_xyzk(n) != add_n_gen.precomp_xyzk_list[n]:
+                print("Wrong xyzk for", n)
+                ok = False
+
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate the lookup tables used by gen_string.py and init_macros.py")
+    parser.add_argument("--check", action="store_true", help="Check the tables instead of writing them")
+    parser.add_argument("--samples", type=int, default=200, help="Number of table entries to compare with the full searches")
+
+    args = parser.parse_args()
+
+    if args.check:
+        if check(args.samples):
+            print("Tables are up to date")
+        else:
+            exit(1)
+    else:
+        gen_string.write_table(gen_string.gen_table())
+        print("Wrote", gen_string.TABLE_PATH)
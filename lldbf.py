@@ -1,6 +1,22 @@
+import os
+import re
 import sys
 import ast
 import time
+import pickle
+import atexit
+import hashlib
+import argparse
+import contextlib
+import json
+import math
+import signal
+import mmap
+from array import array
+from functools import partial
+from itertools import accumulate
+
+import colorama
 
 
 def pad_start(st, wanted_len, padding=" "):
@@ -25,6 +41,8 @@ def hex_byte_signed(b, plus_for_positive=False):
 
 
 class Unit:
+    __slots__ = ["typ", "param"]
+
     JUMP_FORWARD_INVALID = -1
     INCDEC = 0
     MOV = 1
@@ -32,6 +50,10 @@ class Unit:
     JUMP_BACKWARD = 3
     PRINT = 4
     READ = 5
+    SET_ZERO = 6
+    MUL_ADD = 7
+    SCAN = 8
+    FUSED = 9
 
     def __init__(self, typ, param):
         self.typ = typ
@@ -69,6 +91,15 @@ class Unit:
             return "."
         if self.typ == Unit.READ:
             return ","
+        if self.typ == Unit.SET_ZERO:
+            return "=0"
+        if self.typ == Unit.MUL_ADD:
+            return "*{" + ",".join(
+                str(offset) + ":" + "{:+d}".format(factor if factor < 128 else factor - 256)
+                for offset, factor in self.param
+            ) + "}"
+        if self.typ == Unit.SCAN:
+            return "[" + str(Unit(Unit.MOV, self.param)) + "]"
 
 
 # Units: tuple of [type, *params]
@@ -80,65 +111,425 @@ class Unit:
 #   3 = ], *params = index of matching
 #   4 = .
 #   5 = ,
+# Only produced by optimize_units:
+#   6 = [-], sets the current cell to zero
+#   7 = [->+>++<<] and friends, *params = list of (offset, factor)
+#       Adds the current cell times factor to every offset, then clears the current cell
+#   8 = [>], *params = step, moves by step until the current cell is zero
+# Only used in OffsetProgram.fused_ops:
+#   9 = a run of instructions, *params = generated function running them
+
+
+# A whole program, stored as two arrays of unit types and params instead of
+# a list of Units, since compiled programs can have hundreds of thousands of
+# them. program[i] still gives a Unit, for printing.
+# MUL_ADD params are lists, so for those params holds an index into pairs,
+# and missing params are stored as 0.
+# offsets, if kept, has where each unit starts in the code it was parsed from,
+# to look units up in the source map of compiled bfpp
+class Program:
+    def __init__(self, typs=None, params=None, pairs=None, offsets=None):
+        self.typs = typs if typs is not None else array("i")
+        self.params = params if params is not None else array("i")
+        self.pairs = pairs if pairs is not None else []
+        self.offsets = offsets
+
+    def append(self, typ, param, offset=None):
+        if typ == Unit.MUL_ADD:
+            self.pairs.append(param)
+            param = len(self.pairs) - 1
+        elif param is None:
+            param = 0
+        self.typs.append(typ)
+        self.params.append(param)
+        if self.offsets is not None:
+            self.offsets.append(offset)
+
+    def pop(self):
+        self.typs.pop()
+        self.params.pop()
+        if self.offsets is not None:
+            self.offsets.pop()
+
+    def param(self, i):
+        if self.typs[i] == Unit.MUL_ADD:
+            return self.pairs[self.params[i]]
+        return self.params[i]
+
+    def __len__(self):
+        return len(self.typs)
+
+    def __getitem__(self, i):
+        return Unit(self.typs[i], self.param(i))
+
+
+COMMANDS = "+-<>[].,"
+
+# A run of +- or <>, or any other single command
+RUN_PATTERN = re.compile(r"[+-]+|[<>]+|[\[\].,]")
+
+
+class UnmatchedBracketError(Exception):
+    pass
+
+
+# Returns where all unmatched brackets in code_str are, as (line, column, ch)
+def unmatched_brackets(code_str):
+    unmatched = []
+    brack_stack = []
+    line, column = 1, 1
+    for ch in code_str:
+        if ch == "[":
+            brack_stack.append((line, column, ch))
+        elif ch == "]":
+            if len(brack_stack) > 0:
+                brack_stack.pop()
+            else:
+                unmatched.append((line, column, ch))
 
+        if ch == "\n":
+            line, column = line + 1, 1
+        else:
+            column += 1
+
+    return sorted(unmatched + brack_stack)
+
+
+# Returns (type, param) for a run matched by RUN_PATTERN
+def parse_run(run):
+    ch = run[0]
+    if ch in "+-":
+        return Unit.INCDEC, (run.count("+") - run.count("-")) % 256
+    if ch in "<>":
+        return Unit.MOV, run.count(">") - run.count("<")
+    if ch == "[":
+        return Unit.JUMP_FORWARD_INVALID, 0
+    if ch == "]":
+        return Unit.JUMP_BACKWARD, 0
+    if ch == ".":
+        return Unit.PRINT, 0
+    return Unit.READ, 0
+
+
+# With offsets, the units keep where they start in code_str, see Program
+def parse_code(code_str, offsets=False):
+    # Everything that isn't a command is a comment
+    comment_chars = "".join(set(code_str) - set(COMMANDS))
+    commands = code_str.translate(str.maketrans("", "", comment_chars))
+
+    runs = RUN_PATTERN.findall(commands)
+    # The same few runs show up over and over again, so only parse each once
+    parsed = {run: parse_run(run) for run in set(runs)}
+
+    if offsets:
+        code_units = Program(offsets=array("L"))
+        unit_offsets = code_units.offsets
+        # Where each run starts in commands
+        run_starts = iter(accumulate(map(len, runs), initial=0))
+    else:
+        code_units = Program()
+        unit_offsets = None
+    typs = code_units.typs
+    params = code_units.params
 
-def parse_code(code_str):
-    code_units = []
+    INCDEC = Unit.INCDEC
+    MOV = Unit.MOV
+    JUMP_FORWARD_INVALID = Unit.JUMP_FORWARD_INVALID
+    JUMP_BACKWARD = Unit.JUMP_BACKWARD
 
     brack_stack = []
-    last = ""
-    idx = 0
-    for ch in code_str:
-        if ch in "+-":
-            val = 1 if ch == "+" else 255
-            if len(code_units) > 0 and code_units[-1].typ == Unit.INCDEC:
-                code_units[-1].param += val
-                code_units[-1].param %= 256
-                if code_units[-1].param == 0:
-                    code_units.pop()
-                    idx -= 1
+    balanced = True
+    last = None # Type of the last unit
+    for run in runs:
+        typ, val = parsed[run]
+        if unit_offsets is not None:
+            start = next(run_starts)
+        if typ == INCDEC or typ == MOV:
+            # Runs next to each other are never the same type, unless the
+            # ones between them added up to nothing
+            if typ == last:
+                val += params[-1]
+                if typ == INCDEC:
+                    val %= 256
+                typs.pop()
+                params.pop()
+                if unit_offsets is not None:
+                    # The merged unit starts where the earlier one did
+                    start = unit_offsets.pop()
+                last = typs[-1] if len(typs) > 0 else None
+            if val == 0:
                 continue
-            else:
-                code_units.append(Unit(Unit.INCDEC, val))
+        elif typ == JUMP_FORWARD_INVALID:
+            brack_stack.append(len(typs))
+        elif typ == JUMP_BACKWARD:
+            if len(brack_stack) == 0:
+                balanced = False
+                break
+            val = brack_stack.pop()
+            typs[val] = Unit.JUMP_FORWARD
+            params[val] = len(typs)
+
+        typs.append(typ)
+        params.append(val)
+        if unit_offsets is not None:
+            unit_offsets.append(start)
+        last = typ
+
+    if not balanced or len(brack_stack) > 0:
+        raise UnmatchedBracketError(", ".join(
+            "Unmatched {} at line {}, column {}".format(ch, line, column)
+            for line, column, ch in unmatched_brackets(code_str)
+        ))
+
+    if unit_offsets is not None and len(comment_chars) > 0:
+        # From offsets into commands to offsets into code_str
+        command_at = [i for i, ch in enumerate(code_str) if ch in COMMANDS]
+        code_units.offsets = array("L", (command_at[at] for at in unit_offsets))
+
+    return code_units
 
-        elif ch in "<>":
-            val = 1 if ch == ">" else -1
-            if len(code_units) > 0 and code_units[-1].typ == Unit.MOV:
-                code_units[-1].param += val
-                if code_units[-1].param == 0:
-                    code_units.pop()
-                    idx -= 1
 
+# Returns (type, param) of a unit replacing the loop starting at start, or
+# None if the loop isn't one of the idioms optimize_units knows about
+def match_idiom(units, start):
+    typs = units.typs
+    params = units.params
+    end = params[start]
+
+    if end == start + 2 and typs[start + 1] == Unit.INCDEC and params[start + 1] % 2 == 1:
+        # Any odd step hits zero eventually
+        return Unit.SET_ZERO, None
+
+    if end == start + 2 and typs[start + 1] == Unit.MOV:
+        return Unit.SCAN, params[start + 1]
+
+    changes = {} # {offset: amount}
+    offset = 0
+    for i in range(start + 1, end):
+        if typs[i] == Unit.INCDEC:
+            changes[offset] = (changes.get(offset, 0) + params[i]) % 256
+        elif typs[i] == Unit.MOV:
+            offset += params[i]
+        else:
+            return None
+
+    if offset != 0:
+        return None
+
+    counter = changes.pop(0, 0)
+    if counter == 255:
+        # The loop runs cell times
+        sign = 1
+    elif counter == 1:
+        # The loop runs 256 - cell times, same as adding -factor cell times
+        sign = -1
+    else:
+        return None
+
+    pairs = [
+        (at, (sign * amount) % 256)
+        for at, amount in sorted(changes.items())
+        if amount != 0
+    ]
+    return Unit.MUL_ADD, pairs
+
+
+# Replaces common loop idioms with single units, see match_idiom
+def optimize_units(units):
+    optimized = Program(offsets=array("L") if units.offsets is not None else None)
+
+    brack_stack = []
+    i = 0
+    while i < len(units):
+        typ = units.typs[i]
+        offset = units.offsets[i] if units.offsets is not None else None
+        if typ == Unit.JUMP_FORWARD:
+            idiom = match_idiom(units, i)
+            if idiom is not None:
+                optimized.append(*idiom, offset)
+                i = units.params[i] + 1
                 continue
-            else:
-                code_units.append(Unit(Unit.MOV, val))
-        elif ch == "[":
-            code_units.append(Unit(Unit.JUMP_FORWARD_INVALID, None))
-            brack_stack.append(idx)
-        elif ch == "]":
-            last_brack_idx = brack_stack.pop()
-            code_units.append(Unit(Unit.JUMP_BACKWARD, last_brack_idx))
-            code_units[last_brack_idx] = Unit(Unit.JUMP_FORWARD, idx)
-        elif ch == ".":
-            code_units.append(Unit(Unit.PRINT, None))
-        elif ch == ",":
-            code_units.append(Unit(Unit.READ, None))
+
+            brack_stack.append(len(optimized))
+            optimized.append(Unit.JUMP_FORWARD, None, offset)
+        elif typ == Unit.JUMP_BACKWARD:
+            start = brack_stack.pop()
+            optimized.params[start] = len(optimized)
+            optimized.append(Unit.JUMP_BACKWARD, start, offset)
         else:
-            continue
+            optimized.append(typ, units.param(i), offset)
+
+        i += 1
+
+    return optimized
+
+
+# The tape
+# Cells are stored in a bytearray, or an anonymous mmap once the tape gets
+# big, and it grows in both directions as needed.
+#
+# Cell mp is stored at cells[mp + origin]. The debugger uses mp directly
+# through tape[mp], while run_until_break works on indices into cells, that is
+# mp + origin. Growing to the left moves all cells, so fit returns how far
+# they moved, to be added to any index into cells being held on to.
+
+TAPE_PREALLOC = 30000
+MMAP_THRESHOLD = 1 << 26 # Cells
+
+
+class TapeLimitError(Exception):
+    pass
+
+
+class Tape:
+    def __init__(self, size=TAPE_PREALLOC, limit=None):
+        self.limit = limit
+        self.cells = self.new_cells(size)
+        self.origin = 0
+
+    def new_cells(self, size):
+        if size >= MMAP_THRESHOLD:
+            return mmap.mmap(-1, size)
+        return bytearray(size)
+
+    # Makes sure cells[lo] to cells[hi] exist
+    # Returns how far the existing cells moved
+    def fit(self, lo, hi):
+        size = len(self.cells)
+        if lo >= 0 and hi < size:
+            return 0
+
+        # Grow geometrically, but never past the limit
+        need_left = max(0, -lo)
+        need_right = max(0, hi - size + 1)
+        grow_left = max(need_left, size) if need_left > 0 else 0
+        grow_right = max(need_right, size) if need_right > 0 else 0
+
+        if self.limit is not None and size + grow_left + grow_right > self.limit:
+            grow_left, grow_right = need_left, need_right
+            if size + grow_left + grow_right > self.limit:
+                raise TapeLimitError("Tape would be larger than {} cells".format(self.limit))
+
+        new_size = size + grow_left + grow_right
+        if grow_left == 0 and type(self.cells) == bytearray and new_size < MMAP_THRESHOLD:
+            self.cells.extend(bytes(grow_right))
+            return 0
+
+        cells = self.new_cells(new_size)
+        cells[grow_left:grow_left + size] = self.cells
+        self.cells = cells
+        self.origin += grow_left
+        return grow_left
+
+    def __getitem__(self, mp):
+        at = mp + self.origin
+        if 0 <= at < len(self.cells):
+            return self.cells[at]
+        return 0
 
-        idx += 1
-        last = ch
+    def __setitem__(self, mp, val):
+        at = mp + self.origin
+        at += self.fit(at, at)
+        self.cells[at] = val % 256
+
+    def __len__(self):
+        return len(self.cells)
+
+
+# Output of the program being debugged
+# Writing every byte to the terminal on its own is slow, so they are
+# collected and written on a newline, once enough have been collected, or
+# when flush is called, which the debugger does before printing anything
+# itself. Everything ever written is also kept in history.
+
+OUTPUT_FLUSH_SIZE = 4096
 
-    return code_units
 
+class OutputSink:
+    def __init__(self, raw=False, flush_size=OUTPUT_FLUSH_SIZE):
+        self.raw = raw # Write bytes to sys.stdout.buffer instead of characters to sys.stdout
+        self.flush_size = flush_size
+        self.history = bytearray()
+        self.pending = bytearray()
 
+    def write(self, val):
+        self.history.append(val)
+        self.pending.append(val)
+        if val == 10 or len(self.pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        if self.raw:
+            sys.stdout.flush()
+            sys.stdout.buffer.write(self.pending)
+            sys.stdout.buffer.flush()
+        else:
+            # Same as printing chr of every byte
+            sys.stdout.write(self.pending.decode("latin-1"))
+            sys.stdout.flush()
+        self.pending.clear()
+
+
+# Operations for the idiom units, shared between the debugger and run_until_break
+# at is an index into tape.cells, and both return it after growing the tape
+
+def mul_add(tape, at, pairs):
+    cells = tape.cells
+    value = cells[at]
+    if value == 0:
+        return at
+
+    offsets = [offset for offset, _ in pairs] + [0]
+    lo = at + min(offsets)
+    hi = at + max(offsets)
+    if lo < 0 or hi >= len(cells):
+        at += tape.fit(lo, hi)
+        cells = tape.cells
+
+    for offset, factor in pairs:
+        cells[at + offset] = (cells[at + offset] + value * factor) & 255
+    cells[at] = 0
+    return at
+
+
+def scan(tape, at, step):
+    cells = tape.cells
+    if step == 1:
+        found = cells.find(b"\0", at)
+        if found != -1:
+            return found
+        # Everything past the end is zero
+        at = len(cells)
+        return at + tape.fit(at, at)
+
+    if step == -1:
+        found = cells.rfind(b"\0", 0, at + 1)
+        if found != -1:
+            return found
+        at = -1
+        return at + tape.fit(at, at)
+
+    while cells[at] != 0:
+        at += step
+        if at < 0 or at >= len(cells):
+            at += tape.fit(at, at)
+            cells = tape.cells
+    return at
+
+
+# Returns (graph, line, cont) for every line, or (heat, graph, line, cont) if
+# heat is given, which then has a number for every unit, such as Profile.hits.
+# The heat of a line is the highest of the units on it.
 def pretty_print_code_slice(units,
                             start,
                             end,
                             cont_max_width=30,
                             graph_width=0,
                             depth_start=0,
-                            mark_inst=-1):
+                            mark_inst=-1,
+                            heat=None):
     depth = depth_start
     lines = []
 
@@ -154,7 +545,7 @@ def pretty_print_code_slice(units,
 
         special = False
         cont = None
-        if units[i].typ == Unit.JUMP_FORWARD:
+        if units.typs[i] == Unit.JUMP_FORWARD:
             graph = "| " * depth + ",-" + "--" * (graph_width - depth - 1)
             depth += 1
             if i == mark_inst:
@@ -163,7 +554,7 @@ def pretty_print_code_slice(units,
             else:
                 cont = "["
             i += 1
-        elif units[i].typ == Unit.JUMP_BACKWARD:
+        elif units.typs[i] == Unit.JUMP_BACKWARD:
             depth -= 1
             graph = "| " * depth + "`-" + "--" * (graph_width - depth - 1)
             if i == mark_inst:
@@ -175,7 +566,7 @@ def pretty_print_code_slice(units,
         else:
             cont = ""
             while len(cont) < cont_max_width and i < end:
-                if units[i].typ in [Unit.JUMP_FORWARD, Unit.JUMP_BACKWARD]:
+                if units.typs[i] in [Unit.JUMP_FORWARD, Unit.JUMP_BACKWARD]:
                     break
                 unit = str(units[i])
                 if i == mark_inst:
@@ -192,7 +583,10 @@ def pretty_print_code_slice(units,
         else:
             line = " " + line
 
-        lines.append((graph, line, cont))
+        if heat is not None:
+            lines.append((max(heat[i_start:i]), graph, line, cont))
+        else:
+            lines.append((graph, line, cont))
 
         max_depth = max(max_depth, depth)
         min_depth = min(min_depth, depth)
@@ -204,34 +598,1361 @@ def pretty_print_code_slice(units,
                                        cont_max_width,
                                        graph_width=max_depth - min_depth,
                                        depth_start=-min_depth,
-                                       mark_inst=mark_inst)
+                                       mark_inst=mark_inst,
+                                       heat=heat)
 
     return lines
 
+
+# Fast path, used when running between breakpoints.
+# The program is flattened into two plain lists, ops and params, with the
+# MUL_ADD pairs in params, so that the dispatch loop doesn't do any attribute
+# lookups or method calls
+
+RUN_BREAK = 0 # Reached a stop
+RUN_INPUT = 1 # Reached a , without any input left
+RUN_INTERRUPT = 2 # Got Ctrl-C
+RUN_TAPE_LIMIT = 3 # The tape would grow past its limit
+RUN_STEP_LIMIT = 4 # Executed as many units as it was allowed to
+
+# Step limit when there isn't any
+NO_STEP_LIMIT = sys.maxsize
+
+
+# Ctrl-C while running
+# A KeyboardInterrupt can arrive between any two bytecodes, such as halfway
+# through a fused run or an iteration of a compiled loop, and running from
+# there again would do part of it twice. Instead, while a program runs, SIGINT
+# turns every unit into a stop, so that the run stops as soon as the
+# instruction it is on is done. Compiled loops run while the iterations are
+# less than budget[0], which SIGINT sets to 0, so they stop between
+# iterations. release puts the stops back. Other ways to stop a run, such as
+# the --timeout alarm, go through interrupt_run.
+class Interrupts:
+    def __init__(self, stops):
+        global ACTIVE_INTERRUPTS
+
+        self.stops = stops
+        self.interrupted = False
+        self.budget = [0]
+        self.saved_stops = None
+        ACTIVE_INTERRUPTS = self
+        try:
+            self.previous = signal.signal(signal.SIGINT, self.on_interrupt)
+        except ValueError:
+            # Not the main thread, which is the only one Ctrl-C arrives in
+            self.previous = None
+
+    def on_interrupt(self, signum, frame):
+        if not self.interrupted:
+            self.saved_stops = bytes(self.stops)
+            self.stops[:] = b"\1" * len(self.stops)
+            self.interrupted = True
+        self.budget[0] = 0
+
+    # Sets the budget of a compiled loop, unless interrupted already
+    def set_budget(self, iterations):
+        self.budget[0] = iterations
+        # In case the interrupt came just before that
+        if self.interrupted:
+            self.budget[0] = 0
+
+    # Returns whether there was an interrupt
+    def release(self):
+        global ACTIVE_INTERRUPTS
+
+        ACTIVE_INTERRUPTS = None
+        if self.previous is not None:
+            signal.signal(signal.SIGINT, self.previous)
+        if self.saved_stops is not None:
+            self.stops[:] = self.saved_stops
+        return self.interrupted
+
+
+# The Interrupts of the run in progress, or None between runs
+ACTIVE_INTERRUPTS = None
+
+
+# Stops the run in progress the same way Ctrl-C does. Between runs, where
+# nothing is left half done, it raises KeyboardInterrupt instead.
+def interrupt_run():
+    if ACTIVE_INTERRUPTS is None:
+        raise KeyboardInterrupt
+    ACTIVE_INTERRUPTS.on_interrupt(signal.SIGINT, None)
+
+
+def flatten_units(units):
+    ops = list(units.typs)
+    params = [units.param(i) for i in range(len(units))]
+    return ops, params
+
+
+def stops_for(breakpoints, n_units):
+    stops = bytearray(n_units + 1)
+    for bp in breakpoints:
+        if type(bp) == int and 0 <= bp <= n_units:
+            stops[bp] = 1
+    stops[n_units] = 1
+    return stops
+
+
+# Offset-addressed form of a program, which is what run_until_break runs
+#
+# Within a stretch of code without jumps, <> don't have to move the pointer
+# right away. Instead every instruction gets an offset from where the pointer
+# was at the start of the stretch, and the total move is done once at the end
+# of it. `to var` in bfpp emits lots of <>, so most moves disappear this way.
+#
+# Stops (breakpoints) are kept as their own lowered instruction, with the
+# pointer moved to the right place before them, so that execution can stop
+# there exactly like the debugger would.
+#
+# Each lowered instruction also remembers:
+#   origin: the index of the unit it came from, that is where the debugger is
+#           just before it runs
+#   offset: how far the pointer in the debugger is from the pointer in the
+#           lowered program just before it runs
+#   cost:   how many units running it corresponds to, so that instruction
+#           counts stay the same as when running unit by unit
+#
+# With step_limited, ] are never fused into the runs before them, so that
+# run_until_break gets to check the step limit on every jump back.
+class OffsetProgram:
+    def __init__(self, ops, params, stops, step_limited=False):
+        self.ops = []
+        self.params = []
+        self.offsets = []
+        self.costs = []
+        self.origins = []
+
+        lowered_jumps = {} # {unit index: lowered index}
+        lowered_stops = []
+
+        move = 0 # Moves done since the start of the stretch
+        move_cost = 0 # Number of moves not yet accounted for in any cost
+        move_origin = 0 # Where the first move not yet accounted for came from
+        move_offset = 0 # Value of move just before that
+
+        for i in range(len(ops)):
+            op = ops[i]
+
+            if stops[i]:
+                if move != 0 or move_cost != 0:
+                    self.add_move(move, move_cost, move_origin, move_offset, i)
+                    move = move_cost = 0
+                lowered_stops.append(len(self.ops))
+
+                if op == Unit.MOV:
+                    # Needs to be its own instruction, so there's something to stop at
+                    self.add(op, params[i], 0, i, 1)
+                    continue
+
+            if op == Unit.MOV:
+                if move_cost == 0:
+                    move_origin = i
+                    move_offset = move
+                move += params[i]
+                move_cost += 1
+
+            elif op in [Unit.JUMP_FORWARD, Unit.JUMP_BACKWARD, Unit.JUMP_FORWARD_INVALID]:
+                # Jumps check the current cell, and have to land on a stretch start
+                if move != 0:
+                    self.add_move(move, move_cost, move_origin, move_offset, i)
+                    move = move_cost = 0
+                lowered_jumps[i] = len(self.ops)
+                self.add(op, params[i], 0, i, 1 + move_cost)
+                move_cost = 0
+
+            elif op == Unit.SCAN:
+                # Starts scanning at the offset, and the pointer is exact afterwards
+                self.add(op, params[i], move, i, 1 + move_cost)
+                move = move_cost = 0
+
+            else:
+                self.add(op, params[i], move, i, 1 + move_cost)
+                move_cost = 0
+
+        if move != 0 or move_cost != 0:
+            self.add_move(move, move_cost, move_origin, move_offset, len(ops))
+
+        # Sentinel for the end of the program
+        self.offsets.append(0)
+        self.origins.append(len(ops))
+
+        for i, op in enumerate(self.ops):
+            if op in [Unit.JUMP_FORWARD, Unit.JUMP_BACKWARD]:
+                self.params[i] = lowered_jumps[self.params[i]]
+
+        self.stops = bytearray(len(self.ops) + 1)
+        for at in lowered_stops:
+            self.stops[at] = 1
+        self.stops[len(self.ops)] = 1
+
+        # How far away from the pointer instructions can reach
+        self.lowest = min(self.offsets)
+        self.reach = max(self.offsets)
+
+        # {unit index: lowered index}, for where execution can start
+        self.entries = {}
+        for i in range(len(self.ops) - 1, -1, -1):
+            if self.ops[i] == Unit.MOV and self.costs[i] == 0:
+                # Only does moves the debugger has already done, start after it
+                continue
+            self.entries[self.origins[i]] = i
+
+        self.loops = compile_loops(self)
+        self.fused_ops, self.fused_params, self.fused_costs = fuse_runs(self, step_limited)
+
+    # Where to start running when the debugger is at unit ip with pointer mp
+    # Returns (lowered ip, lowered mp, cost already run), or None if ip is a
+    # move that has been folded into the instructions after it
+    def enter(self, ip, mp):
+        if ip not in self.entries:
+            return None
+
+        lowered_ip = self.entries[ip]
+        lowered_mp = mp - self.offsets[lowered_ip]
+
+        # Moves folded into the instruction have already run in the debugger
+        if self.ops[lowered_ip] == Unit.MOV:
+            already_run = 0
+        else:
+            already_run = self.costs[lowered_ip] - 1
+
+        return lowered_ip, lowered_mp, already_run
+
+    # Returns (ip, mp, cost already run) for the debugger, where the cost is
+    # for the moves folded into lowered_ip, which the debugger has done
+    def leave(self, lowered_ip, lowered_mp):
+        ip = self.origins[lowered_ip]
+        mp = lowered_mp + self.offsets[lowered_ip]
+        if lowered_ip == len(self.ops) or self.ops[lowered_ip] == Unit.MOV:
+            return ip, mp, 0
+        return ip, mp, self.costs[lowered_ip] - 1
+
+    # Does the moves of a stretch, just before the unit at index next_unit
+    def add_move(self, move, move_cost, move_origin, move_offset, next_unit):
+        if move_cost == 0:
+            # All moves are accounted for, so the debugger is already at next_unit
+            self.add(Unit.MOV, move, move, next_unit, 0)
+        else:
+            self.add(Unit.MOV, move, move_offset, move_origin, move_cost)
+
+    def add(self, op, param, offset, origin, cost):
+        self.ops.append(op)
+        self.params.append(param)
+        self.offsets.append(offset)
+        self.origins.append(origin)
+        self.costs.append(cost)
+
+
+# JIT for innermost loops
+# A loop containing only +-<> is turned into a python while-loop with all the
+# +- folded into one addition per cell, compiled once, and run in one go by
+# run_until_break instead of dispatching every unit.
+#
+# Big programs have tens of thousands of such loops and runs (see below), most
+# of which never run, or are the same code as another one. So each one is only
+# compiled the first time it runs, and compiled code is shared by all loops and
+# runs with the same source, also across OffsetPrograms, which the debugger
+# builds again every time the breakpoints change.
+
+# {generated source: compiled function}
+GENERATED = {}
+
+# Names generated code can use
+GENERATED_NAMESPACE = {"RUN_TAPE_LIMIT": RUN_TAPE_LIMIT, "TapeLimitError": TapeLimitError}
+
+
+# Returns the function called name defined by source
+def compile_generated(source, name):
+    function = GENERATED.get(source)
+    if function is None:
+        namespace = dict(GENERATED_NAMESPACE)
+        exec(compile(source, "<generated " + name + ">", "exec"), namespace)
+        function = namespace[name]
+        GENERATED[source] = function
+    return function
+
+
+# Stands in for the function called name in the source generate() returns,
+# until it is first called. Then it compiles it and passes it to install,
+# which puts it where the stand-in was, so that it's called directly after.
+class LazyFunction:
+    def __init__(self, generate, name, install):
+        self.generate = generate
+        self.name = name
+        self.install = install
+
+    def __call__(self, *args):
+        function = compile_generated(self.generate(), self.name)
+        self.install(function)
+        return function(*args)
+
+
+def tape_offset(offset):
+    if offset == 0:
+        return "p"
+    if offset > 0:
+        return "p + " + str(offset)
+    return "p - " + str(-offset)
+
+
+# Returns ({offset: amount added}, move) for one iteration of the loop
+# starting at start, or None if it can't be compiled
+def loop_changes(program, start):
+    end = program.params[start]
+
+    changes = {} # {offset: amount}
+    offset = 0
+    for i in range(start + 1, end):
+        if program.stops[i]:
+            return None
+        if program.ops[i] == Unit.INCDEC:
+            at = offset + program.offsets[i]
+            changes[at] = (changes.get(at, 0) + program.params[i]) % 256
+        elif program.ops[i] == Unit.MOV:
+            offset += program.params[i]
+        else:
+            return None
+    if program.stops[end]:
+        return None
+    return changes, offset
+
+
+# Returns the source of the compiled version of a loop, see loop_changes
+def loop_source(changes, offset):
+    # Cells used by this iteration, and the reach of the next one
+    lowest = min([0] + list(changes.keys()))
+    highest = max([0] + list(changes.keys()))
+    lowest = min(lowest, lowest + offset)
+    highest = max(highest, highest + offset)
+
+    # Grows the tape before anything changes, so that an iteration either
+    # runs completely or not at all
+    body = [
+        "if " + tape_offset(lowest) + " < 0 or " + tape_offset(highest) + " >= len(cells):",
+        "    p += tape.fit(" + tape_offset(lowest) + ", " + tape_offset(highest) + ")",
+        "    cells = tape.cells",
+    ]
+    for at, amount in changes.items():
+        if amount != 0:
+            cell = "cells[" + tape_offset(at) + "]"
+            body.append(cell + " = (" + cell + " + " + str(amount) + ") & 255")
+    if offset != 0:
+        body.append("p += " + str(offset))
+    body.append("n += 1")
+
+    # Stops at iteration boundaries, where p is where the loop's [ expects it,
+    # after at most budget[0] iterations, see Interrupts
+    lines = ["def loop(tape, p, budget):", "    cells = tape.cells", "    n = 0"]
+    lines += ["    try:"]
+    lines += ["        while cells[p] and n < budget[0]:"]
+    lines += ["            " + line for line in body]
+    lines += [
+        "    except TapeLimitError:",
+        "        return p, n, RUN_TAPE_LIMIT",
+        "    return p, n, None",
+    ]
+    return "\n".join(lines)
+
+
+# Returns {start index: (compiled loop, cost of one iteration)} for all
+# innermost loops in an OffsetProgram that can be compiled
+def compile_loops(program):
+    loops = {}
+    for start, op in enumerate(program.ops):
+        if op == Unit.JUMP_FORWARD:
+            changes = loop_changes(program, start)
+            if changes is not None:
+                # Each iteration runs the body and the ]
+                end = program.params[start]
+                cost = sum(program.costs[start + 1:end + 1])
+
+                def install(loop, start=start, cost=cost):
+                    loops[start] = loop, cost
+
+                loops[start] = LazyFunction(partial(loop_source, *changes), "loop", install), cost
+    return loops
+
+
+# Superinstructions
+# Counting dispatches on compiled bfpp programs, most of what isn't already
+# a compiled loop is moves right before a [ or ], and runs of +-, SET_ZERO and
+# MUL_ADD on cells next to each other, which is what `to var` and copying
+# variables turn into. Each such run, including the jump ending it, is turned
+# into one generated function, so that it only needs a single dispatch.
+#
+# The other instructions of a run are left as they are, so that the debugger
+# can still start in the middle of it.
+
+FUSABLE = [Unit.INCDEC, Unit.MOV, Unit.SET_ZERO, Unit.MUL_ADD]
+
+
+# Returns the source of a function running the instructions from start to
+# end, inclusive, where only end can be a jump
+# The function is called with (tape, p, ip) at start, and returns (p, ip)
+# after running them. ip is relative, so that identical runs share the code.
+def run_source(program, start, end):
+    body = []
+    used = [0]
+
+    move = 0
+    for i in range(start, end + 1):
+        op = program.ops[i]
+        param = program.params[i]
+        at = move + program.offsets[i]
+        cell = "cells[" + tape_offset(at) + "]"
+
+        if op == Unit.INCDEC:
+            body.append(cell + " = (" + cell + " + " + str(param) + ") & 255")
+            used.append(at)
+        elif op == Unit.SET_ZERO:
+            body.append(cell + " = 0")
+            used.append(at)
+        elif op == Unit.MUL_ADD:
+            body += ["v = " + cell, "if v:"]
+            for offset, factor in param:
+                target = "cells[" + tape_offset(at + offset) + "]"
+                body.append("    " + target + " = (" + target + " + v * " + str(factor) + ") & 255")
+                used.append(at + offset)
+            body.append("    " + cell + " = 0")
+            used.append(at)
+        elif op == Unit.MOV:
+            move += param
+
+    if move != 0:
+        body.append("p += " + str(move))
+
+    # The cells in reach of where the run ends have to exist as well
+    lowest = min(used + [move + program.lowest])
+    highest = max(used + [move + program.reach])
+
+    # Grows the tape before anything changes, like compiled loops
+    lines = ["def run(tape, p, ip):", "    cells = tape.cells"]
+    if lowest < program.lowest or highest > program.reach:
+        lines += [
+            "    if " + tape_offset(lowest) + " < 0 or " + tape_offset(highest) + " >= len(cells):",
+            "        p += tape.fit(" + tape_offset(lowest) + ", " + tape_offset(highest) + ")",
+            "        cells = tape.cells",
+        ]
+    lines += ["    " + line for line in body]
+
+    def jump_to(target):
+        return "p, ip " + ("+ " + str(target - start) if target >= start else "- " + str(start - target))
+
+    op = program.ops[end]
+    if op == Unit.JUMP_FORWARD:
+        lines += ["    if cells[p]:", "        return " + jump_to(end + 1)]
+        lines += ["    return " + jump_to(program.params[end] + 1)]
+    elif op == Unit.JUMP_BACKWARD:
+        lines += ["    if cells[p]:", "        return " + jump_to(program.params[end] + 1)]
+        lines += ["    return " + jump_to(end + 1)]
+    else:
+        lines += ["    return " + jump_to(end + 1)]
+
+    return "\n".join(lines)
+
+
+# Returns the (ops, params, costs) run_until_break uses for an OffsetProgram,
+# where every run that is worth it starts with a fused instruction
+def fuse_runs(program, step_limited):
+    ops = list(program.ops)
+    params = list(program.params)
+    costs = list(program.costs)
+
+    # Compiled loops are never dispatched on
+    skip = bytearray(len(ops))
+    for start in program.loops:
+        end = program.params[start]
+        skip[start + 1:end + 1] = bytes(end - start)
+
+    start = 0
+    while start < len(ops):
+        # A run can start at a stop, but can't stop in the middle
+        end = start
+        while end < len(ops) and ops[end] in FUSABLE and not skip[end] and (end == start or not program.stops[end]):
+            end += 1
+
+        if end < len(ops) and end > start and not program.stops[end]:
+            if ops[end] == Unit.JUMP_BACKWARD and not step_limited or (ops[end] == Unit.JUMP_FORWARD and end not in program.loops):
+                end += 1
+
+        # end is now one past the run
+        # Calling the function costs about as much as two dispatches, so
+        # short runs are only worth it if they save calling mul_add
+        if end - start >= 3 or end - start == 2 and Unit.MUL_ADD in ops[start:end]:
+            def install(run, start=start):
+                params[start] = run
+
+            ops[start] = Unit.FUSED
+            params[start] = LazyFunction(partial(run_source, program, start, end - 1), "run", install)
+            costs[start] = sum(program.costs[start:end])
+            start = end
+        else:
+            start += 1
+
+    return ops, params, costs
+
+
+# Runs an OffsetProgram from ip until a stop is reached, a , has no input to
+# read, the tape reaches its limit, step_limit units have been executed or the
+# user presses Ctrl-C. The instruction at ip is always executed, even if it is
+# a stop, since that is where we stopped last time.
+# ip and mp are in the lowered program, see OffsetProgram.
+# tape, output (an OutputSink) and input_feed are modified in place
+# Returns (ip, mp, number of executed units, reason for stopping), where the
+# instruction at ip hasn't run, and isn't counted
+def run_until_break(program, tape, ip, mp, output, input_feed, step_limit=NO_STEP_LIMIT):
+    INCDEC = Unit.INCDEC
+    MOV = Unit.MOV
+    JUMP_FORWARD = Unit.JUMP_FORWARD
+    JUMP_BACKWARD = Unit.JUMP_BACKWARD
+    PRINT = Unit.PRINT
+    READ = Unit.READ
+    SET_ZERO = Unit.SET_ZERO
+    MUL_ADD = Unit.MUL_ADD
+    SCAN = Unit.SCAN
+    FUSED = Unit.FUSED
+
+    ops = program.fused_ops
+    params = program.fused_params
+    offsets = program.offsets
+    costs = program.fused_costs
+    stops = program.stops
+    loops = program.loops
+    lowest = program.lowest
+    reach = program.reach
+    write = output.write
+
+    executed = 0
+    reason = RUN_BREAK
+
+    # p is mp as an index into cells. All cells in reach of p always exist,
+    # so only moves need to check the bounds.
+    # Growing the tape happens before an instruction changes anything, so if
+    # it hits the limit, the instruction at ip just hasn't run yet.
+    p = mp + tape.origin
+
+    try:
+        p += tape.fit(p + lowest, p + reach)
+    except TapeLimitError:
+        return ip, mp, executed, RUN_TAPE_LIMIT
+    cells = tape.cells
+    n_cells = len(cells)
+
+    interrupts = Interrupts(stops)
+    budget = interrupts.budget
+    try:
+        while True:
+            op = ops[ip]
+            cost = costs[ip]
+            if op == FUSED:
+                p, ip = params[ip](tape, p, ip)
+                cells = tape.cells
+                n_cells = len(cells)
+            elif op == INCDEC:
+                at = p + offsets[ip]
+                cells[at] = (cells[at] + params[ip]) & 255
+                ip += 1
+            elif op == MOV:
+                moved = p + params[ip]
+                if moved + reach >= n_cells or moved + lowest < 0:
+                    moved += tape.fit(moved + lowest, moved + reach)
+                    cells = tape.cells
+                    n_cells = len(cells)
+                p = moved
+                ip += 1
+            elif op == JUMP_FORWARD:
+                if cells[p] == 0:
+                    ip = params[ip] + 1
+                elif ip in loops:
+                    loop, iteration_cost = loops[ip]
+                    # As many iterations as fit in the step limit
+                    max_n = (step_limit - executed) // iteration_cost
+                    interrupts.set_budget(max_n)
+                    p, iterations, stopped = loop(tape, p, budget)
+                    executed += iterations * iteration_cost
+                    # Between iterations, running the [ again is the same as the ]
+                    if stopped is not None:
+                        reason = stopped
+                        break
+                    if cells[p] != 0:
+                        reason = RUN_STEP_LIMIT if iterations == max_n else RUN_INTERRUPT
+                        break
+                    p += tape.fit(p + lowest, p + reach)
+                    cells = tape.cells
+                    n_cells = len(cells)
+                    ip = params[ip] + 1
+                else:
+                    ip += 1
+            elif op == JUMP_BACKWARD:
+                if cells[p] != 0:
+                    # Anything running for long has to jump back, so this is
+                    # the only place the step limit is checked
+                    if executed >= step_limit:
+                        reason = RUN_STEP_LIMIT
+                        break
+                    ip = params[ip] + 1
+                else:
+                    ip += 1
+            elif op == PRINT:
+                write(cells[p + offsets[ip]])
+                ip += 1
+            elif op == READ:
+                if len(input_feed) == 0:
+                    reason = RUN_INPUT
+                    break
+                cells[p + offsets[ip]] = input_feed.pop(0) % 256
+                ip += 1
+            elif op == SET_ZERO:
+                cells[p + offsets[ip]] = 0
+                ip += 1
+            elif op == MUL_ADD:
+                at = p + offsets[ip]
+                p += mul_add(tape, at, params[ip]) - at
+                cells = tape.cells
+                n_cells = len(cells)
+                ip += 1
+            elif op == SCAN:
+                origin = tape.origin
+                found = scan(tape, p + offsets[ip], params[ip])
+                p += tape.origin - origin
+                found += tape.fit(found + lowest, found + reach)
+                p = found
+                cells = tape.cells
+                n_cells = len(cells)
+                ip += 1
+            else:
+                ip += 1
+
+            executed += cost
+            if stops[ip]:
+                break
+    except TapeLimitError:
+        reason = RUN_TAPE_LIMIT
+    finally:
+        # Stopping at a real stop counts as reaching it
+        if interrupts.release() and reason == RUN_BREAK and not stops[ip]:
+            reason = RUN_INTERRUPT
+
+    return ip, p - tape.origin, executed, reason
+
+
+# Profiling
+# Fused runs and compiled loops don't run their units one by one, so profiling
+# runs the units themselves in run_profiled instead, counting into arrays.
+#
+# hits[i] is how many times unit i ran.
+# For every loop there is a histogram of how many iterations it ran each time
+# it was reached, where bucket b counts the times it ran 2**(b-1) to 2**b - 1
+# iterations, so bucket 0 counts the times it was skipped.
+
+HISTOGRAM_BUCKETS = 64
+
+
+class Profile:
+    def __init__(self, units):
+        n_units = len(units)
+        self.hits = array("q", [0]) * n_units
+
+        self.loop_starts = [i for i in range(n_units) if units.typs[i] == Unit.JUMP_FORWARD]
+        self.loop_ends = [units.params[start] for start in self.loop_starts]
+        # Index into loop_starts for every [, -1 for all other units
+        self.loop_slots = array("q", [-1]) * n_units
+        for slot, start in enumerate(self.loop_starts):
+            self.loop_slots[start] = slot
+
+        self.histograms = array("q", [0]) * (len(self.loop_starts) * HISTOGRAM_BUCKETS)
+        # hits of the ] when each loop was last entered
+        self.entered = array("q", [0]) * len(self.loop_starts)
+
+    # Returns [(bucket, count)] for every bucket that isn't empty
+    def histogram(self, slot):
+        at = slot * HISTOGRAM_BUCKETS
+        return [(b, self.histograms[at + b]) for b in range(HISTOGRAM_BUCKETS) if self.histograms[at + b] != 0]
+
+    # Instructions run by the loop in slot, including loops inside it
+    def loop_cost(self, slot):
+        return sum(self.hits[self.loop_starts[slot]:self.loop_ends[slot] + 1])
+
+    # Instructions run by every loop, not counting the loops inside it
+    def self_costs(self):
+        costs = [0] * len(self.loop_starts)
+        inside = []
+        for i, hits in enumerate(self.hits):
+            if self.loop_slots[i] != -1:
+                inside.append(self.loop_slots[i])
+            if len(inside) > 0:
+                costs[inside[-1]] += hits
+                if i == self.loop_ends[inside[-1]]:
+                    inside.pop()
+        return costs
+
+    def to_json(self):
+        self_costs = self.self_costs()
+        loops = []
+        for slot, start in enumerate(self.loop_starts):
+            loops.append({
+                "start": start,
+                "end": self.loop_ends[slot],
+                "instructions": self.loop_cost(slot),
+                "self_instructions": self_costs[slot],
+                "iterations": {bucket_name(b): count for b, count in self.histogram(slot)},
+            })
+        return {"instructions": sum(self.hits), "hits": list(self.hits), "loops": loops}
+
+
+def bucket_name(b):
+    if b <= 1:
+        return str(b)
+    return "{}-{}".format(2 ** (b - 1), 2 ** b - 1)
+
+
+# Runs units from ip like run_until_break, while filling in profile
+# ip and mp are the same as in the debugger, stops are for units like
+# stops_for gives them
+def run_profiled(ops, params, stops, profile, tape, ip, mp, output, input_feed, step_limit=NO_STEP_LIMIT):
+    INCDEC = Unit.INCDEC
+    MOV = Unit.MOV
+    JUMP_FORWARD = Unit.JUMP_FORWARD
+    JUMP_BACKWARD = Unit.JUMP_BACKWARD
+    PRINT = Unit.PRINT
+    READ = Unit.READ
+    SET_ZERO = Unit.SET_ZERO
+    MUL_ADD = Unit.MUL_ADD
+    SCAN = Unit.SCAN
+
+    hits = profile.hits
+    loop_slots = profile.loop_slots
+    histograms = profile.histograms
+    entered = profile.entered
+    write = output.write
+
+    executed = 0
+    reason = RUN_BREAK
+
+    p = mp + tape.origin
+    try:
+        p += tape.fit(p, p)
+    except TapeLimitError:
+        return ip, mp, executed, RUN_TAPE_LIMIT
+    cells = tape.cells
+    n_cells = len(cells)
+
+    interrupts = Interrupts(stops)
+    try:
+        while True:
+            op = ops[ip]
+            if op == INCDEC:
+                cells[p] = (cells[p] + params[ip]) & 255
+            elif op == MOV:
+                moved = p + params[ip]
+                if moved < 0 or moved >= n_cells:
+                    moved += tape.fit(moved, moved)
+                    cells = tape.cells
+                    n_cells = len(cells)
+                p = moved
+            elif op == JUMP_FORWARD:
+                end = params[ip]
+                if cells[p] == 0:
+                    histograms[loop_slots[ip] * HISTOGRAM_BUCKETS] += 1
+                    hits[ip] += 1
+                    executed += 1
+                    ip = end + 1
+                    if stops[ip]:
+                        break
+                    continue
+                entered[loop_slots[ip]] = hits[end]
+            elif op == JUMP_BACKWARD:
+                start = params[ip]
+                if cells[p] != 0:
+                    if executed >= step_limit:
+                        reason = RUN_STEP_LIMIT
+                        break
+                    hits[ip] += 1
+                    executed += 1
+                    ip = start + 1
+                    if stops[ip]:
+                        break
+                    continue
+                slot = loop_slots[start]
+                iterations = hits[ip] + 1 - entered[slot]
+                histograms[slot * HISTOGRAM_BUCKETS + iterations.bit_length()] += 1
+            elif op == PRINT:
+                write(cells[p])
+            elif op == READ:
+                if len(input_feed) == 0:
+                    reason = RUN_INPUT
+                    break
+                cells[p] = input_feed.pop(0) % 256
+            elif op == SET_ZERO:
+                cells[p] = 0
+            elif op == MUL_ADD:
+                p = mul_add(tape, p, params[ip])
+                cells = tape.cells
+                n_cells = len(cells)
+            elif op == SCAN:
+                p = scan(tape, p, params[ip])
+                cells = tape.cells
+                n_cells = len(cells)
+
+            hits[ip] += 1
+            executed += 1
+            ip += 1
+            if stops[ip]:
+                break
+    except TapeLimitError:
+        reason = RUN_TAPE_LIMIT
+    finally:
+        if interrupts.release() and reason == RUN_BREAK and not stops[ip]:
+            reason = RUN_INTERRUPT
+
+    return ip, p - tape.origin, executed, reason
+
+
+# Runs a whole program without the debugger, from the start until it ends or
+# until run_until_break stops for any reason other than a breakpoint
+# on_break(ip, mp, executed) is called at every breakpoint, with ip and mp
+# like the debugger has them. When the program needs input and input_feed is
+# empty, read_input() is called for more, which returns nothing if there isn't
+# any.
+# With a Profile, the program is run by run_profiled, which fills it in.
+# Returns (number of executed units, reason), where reason is None if the
+# program ran to its end
+def run_program(units, tape, output, input_feed, breakpoints=(), step_limit=None, on_break=None, read_input=None, profile=None):
+    if len(units) == 0:
+        return 0, None
+
+    stops = stops_for(breakpoints, len(units))
+    if step_limit is None:
+        step_limit = NO_STEP_LIMIT
+
+    if profile is None:
+        # Starting at the very beginning, the lowered program doesn't have any
+        # moves that the debugger would have done already
+        program = OffsetProgram(*flatten_units(units), stops, step_limit != NO_STEP_LIMIT)
+        end = len(program.ops)
+
+        def run(ip, mp, limit):
+            return run_until_break(program, tape, ip, mp, output, input_feed, limit)
+
+        def leave(ip, mp):
+            return program.leave(ip, mp)
+    else:
+        ops, params = flatten_units(units)
+        end = len(units)
+
+        def run(ip, mp, limit):
+            return run_profiled(ops, params, stops, profile, tape, ip, mp, output, input_feed, limit)
+
+        def leave(ip, mp):
+            return ip, mp, 0
+
+    ip, mp, executed = 0, 0, 0
+    while True:
+        ip, mp, ran, reason = run(ip, mp, step_limit - executed)
+        executed += ran
+
+        # The moves folded into the instruction it stopped at count as run,
+        # the same as in the debugger. They are counted again as part of the
+        # instruction when the run continues from there.
+        stop_ip, stop_mp, moves_run = leave(ip, mp)
+
+        if reason == RUN_BREAK:
+            if ip == end:
+                return executed, None
+            if on_break is not None:
+                on_break(stop_ip, stop_mp, executed + moves_run)
+        elif reason == RUN_INPUT and read_input is not None:
+            more = read_input()
+            if len(more) == 0:
+                return executed + moves_run, reason
+            input_feed.extend(more)
+        else:
+            return executed + moves_run, reason
+
 import sys
 sys.path.append('bfpp')
 
-from main import compile_path_to_str
 
-def read_units(args):
-    if len(args) == 2 and args[0] == "-c":
-        path = args[1]
+# Cache of compiled programs
+# Compiling bfpp (and even importing the compiler) takes a while, so the
+# compiled code and its units are saved in CACHE_DIR. An entry is found by
+# hashing the file together with the options and the source of lldbf and the
+# compiler, and is only used if none of the files it included have changed
+# since.
+
+CACHE_DIR = ".lldbf_cache"
+CACHE_VERSION = 3
+
+
+def hash_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_key(path, compile_bfpp, optimize):
+    key = hashlib.sha256()
+    key.update(repr((CACHE_VERSION, os.path.abspath(path), compile_bfpp, optimize)).encode())
+    key.update(hash_file(path).encode())
+    # parse_code and optimize_units are in here
+    key.update(hash_file(os.path.abspath(__file__)).encode())
+
+    if compile_bfpp:
+        bfpp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bfpp")
+        for name in sorted(os.listdir(bfpp_dir)):
+            if name.endswith(".py"):
+                key.update(hash_file(os.path.join(bfpp_dir, name)).encode())
+
+    return key.hexdigest()
+
+
+# Returns (code_str, units, source_map) if there is an up to date entry,
+# otherwise None
+def read_cache(key):
+    try:
+        with open(os.path.join(CACHE_DIR, key), "rb") as f:
+            entry = pickle.load(f)
+        for dep_path, dep_hash in entry["deps"].items():
+            if hash_file(dep_path) != dep_hash:
+                return None
+    except Exception:
+        # Missing, unreadable or from an older lldbf, just compile again
+        return None
+
+    return entry["code"], Program(*entry["units"]), entry["source_map"]
+
+
+def write_cache(key, code_str, units, source_map, deps):
+    entry = {
+        "deps": {dep_path: hash_file(dep_path) for dep_path in deps},
+        "code": code_str,
+        "units": (units.typs, units.params, units.pairs, units.offsets),
+        "source_map": source_map,
+    }
+
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = os.path.join(CACHE_DIR, key + ".tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f)
+        os.replace(tmp_path, os.path.join(CACHE_DIR, key))
+    except OSError:
+        pass
+
+
+# Returns (units, code_str, source_map). Compiled bfpp comes with the SourceMap
+# of the code (see bfpp/sourcemap.py) and units with offsets, for plain bf the
+# source map is None.
+def read_units(path, compile_bfpp=False, optimize=False, use_cache=True):
+    key = cache_key(path, compile_bfpp, optimize)
+    cached = read_cache(key) if use_cache else None
+
+    if cached is not None:
+        code_str, code_units, source_map = cached
+    else:
+        deps = []
+        source_map = None
+        if compile_bfpp:
+            from main import compile_path_to_str
+            from sourcemap import SourceMap
+
+            included = set()
+            source_map = SourceMap()
+            code_str = compile_path_to_str(path, use_cache=use_cache, included=included, source_map=source_map)
+            deps = sorted(included)
+        else:
+            code_str = open(path).read()
 
-        code_str = compile_path_to_str(path)
-        print(code_str)
-    elif len(args) == 1:
-        code_str = open(args[0]).read()
+        code_units = parse_code(code_str, offsets=source_map is not None)
+        if optimize:
+            code_units = optimize_units(code_units)
+
+        if use_cache:
+            write_cache(key, code_str, code_units, source_map, deps)
+
+    return code_units, code_str, source_map
+
+
+# Source locations of compiled bfpp, see read_units
+
+class BreakpointError(Exception):
+    pass
+
+
+# Returns the frame of the unit at ip, or None if it isn't known
+def unit_frame(units, source_map, ip):
+    if source_map is None or ip >= len(units):
+        return None
+    return source_map.find(units.offsets[ip])
+
+
+# Attributes the move to the arguments at the start of a macro, which is
+# written with the span of the invocation, to the invocation itself
+def merge_invocation(frame):
+    invocations, span = frame
+    if len(invocations) > 0 and invocations[-1][0] is span:
+        return invocations[:-1], span
+    return frame
+
+
+def span_description(span):
+    from sourcemap import span_line
+
+    location = span_line(span)
+    if location is None:
+        return "<generated>"
+    name, line = location
+    return "{}:{}: {}".format(name, line, span.bfile.lines[line - 1].strip())
+
+
+# Returns lines describing where in the bfpp source the unit at ip is: the line
+# of the code itself, followed by the macro invocations it is in, innermost
+# first. Empty if there is no source map.
+def describe_location(units, source_map, ip):
+    frame = unit_frame(units, source_map, ip)
+    if frame is None:
+        return []
+
+    invocations, span = merge_invocation(frame)
+    lines = ["At " + span_description(span)]
+    for invocation, _ in reversed(invocations):
+        lines.append("  from " + span_description(invocation))
+    return lines
+
+
+def same_file(name, wanted):
+    return name == wanted or name.endswith("/" + wanted) or os.path.abspath(name) == os.path.abspath(wanted)
+
+
+# Returns the units to break at for a breakpoint, either a unit index or
+# file:line for compiled bfpp. That is the first unit of every piece of code
+# generated by the line, including macros invoked there.
+def resolve_breakpoint(text, units, source_map):
+    text = text.strip()
+    if ":" not in text:
+        try:
+            at = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            at = None
+        if type(at) != int:
+            raise BreakpointError("expected a unit or file:line, got {!r}".format(text))
+        return {at}
+
+    if source_map is None:
+        raise BreakpointError("file:line breakpoints need a bfpp file, compiled with -c")
+
+    from sourcemap import span_line
+
+    wanted_file, _, wanted_line = text.rpartition(":")
+    try:
+        wanted_line = int(wanted_line)
+    except ValueError:
+        raise BreakpointError("expected a line number after the :, got {!r}".format(text))
+
+    matching = set()
+    for frame_id, (invocations, code_span) in enumerate(source_map.frames):
+        for span in [span for span, _ in invocations] + [code_span]:
+            location = span_line(span)
+            if location is not None and location[1] == wanted_line and same_file(location[0], wanted_file):
+                matching.add(frame_id)
+                break
+
+    res = set()
+    in_line = False
+    for ip, frame_id in enumerate(source_map.frame_ids_at(units.offsets)):
+        if frame_id in matching:
+            if not in_line:
+                res.add(ip)
+            in_line = True
+        else:
+            in_line = False
+
+    if len(res) == 0:
+        raise BreakpointError("no code was generated for " + text)
+    return res
+
+
+# Batch mode, --run
+# Runs the program without any listing or prompts, with its output on stdout and
+# everything lldbf has to say on stderr
+
+EXIT_OK = 0
+EXIT_ERROR = 1 # The program couldn't be compiled or parsed
+EXIT_TIMEOUT = 3 # Hit --max-steps or --timeout
+EXIT_TAPE_LIMIT = 4
+EXIT_INPUT = 5 # Needed input after the end of it, without --eof
+EXIT_INTERRUPT = 130
+
+
+# Colours for the heat column, from cold to hot
+HEAT_COLOURS = [240, 244, 250, 226, 220, 214, 208, 202, 196]
+
+# Most lines of a loop's listing shown in a profile
+PROFILE_LISTING_LINES = 40
+
+
+def heat_colour(hits, max_hits):
+    if hits == 0:
+        return HEAT_COLOURS[0]
+    # Log scale, as counts in nested loops multiply
+    level = math.log(hits + 1) / math.log(max_hits + 1)
+    return HEAT_COLOURS[min(len(HEAT_COLOURS) - 1, 1 + int(level * (len(HEAT_COLOURS) - 1)))]
+
+
+# Prints the top loops that ran the most instructions themselves, with their
+# iteration histograms and listings with a heat column
+def print_profile(units, profile, top, out):
+    total = sum(profile.hits)
+    max_hits = max(profile.hits, default=0)
+    print("\nProfile: {} instructions".format(total), file=out)
+
+    self_costs = profile.self_costs()
+    slots = sorted(range(len(profile.loop_starts)), key=lambda slot: -self_costs[slot])
+
+    for slot in slots[:top]:
+        if self_costs[slot] == 0:
+            break
+        start, end = profile.loop_starts[slot], profile.loop_ends[slot]
+        histogram = profile.histogram(slot)
+
+        print(file=out)
+        print("Loop {}-{}: {} instructions ({:.1f}%), {} with inner loops, reached {} times".format(
+            start, end, self_costs[slot], 100 * self_costs[slot] / max(total, 1),
+            profile.loop_cost(slot), sum(count for _, count in histogram)), file=out)
+        print("Iterations: " + ", ".join("{} x{}".format(bucket_name(b), count) for b, count in histogram), file=out)
+
+        lines = pretty_print_code_slice(units, start, end + 1, heat=profile.hits)
+        heat_width = len(str(max(hits for hits, *_ in lines)))
+        for hits, graph, line, cont in lines[:PROFILE_LISTING_LINES]:
+            print("\033[38;5;%dm%s \033[38;5;2m%s|\033[38;5;3m%s \033[0m%s" %
+                  (heat_colour(hits, max_hits), pad_start(str(hits), heat_width), graph, line, cont), file=out)
+        if len(lines) > PROFILE_LISTING_LINES:
+            print("... {} more lines".format(len(lines) - PROFILE_LISTING_LINES), file=out)
+
+
+# Source level profiles of compiled bfpp
+# The instructions of every unit are attributed to the frame of its code in the
+# source map (see read_units), which gives the line that generated it and the
+# macros it was invoked through. Files are shown by their base name, the same
+# as they are included by.
+
+# Returns (stack, line) for a frame, where stack is the names of the invoked
+# macros, outermost first, and line is "file:line" of the code itself
+def frame_stack(frame):
+    from sourcemap import span_line
+
+    invocations, span = merge_invocation(frame)
+    location = span_line(span)
+    if location is None:
+        line = "<generated>"
     else:
-        print("Please invoke with file or with -c file")
-        exit()
+        line = "{}:{}".format(os.path.basename(location[0]), location[1])
+    return [name for _, name in invocations], line
+
+
+# Returns [(stack, line, instructions)] for every frame that ran any
+def source_costs(units, source_map, profile):
+    costs = {}
+    for ip, frame_id in enumerate(source_map.frame_ids_at(units.offsets)):
+        hits = profile.hits[ip]
+        if hits != 0:
+            costs[frame_id] = costs.get(frame_id, 0) + hits
+
+    res = []
+    for frame_id, instructions in costs.items():
+        stack, line = frame_stack(source_map.frames[frame_id])
+        res.append((stack, line, instructions))
+    return res
+
+
+# Writes the costs in the collapsed stack format of flamegraph.pl and similar
+# tools, one "macro;macro;file:line instructions" per line
+def write_collapsed(costs, out):
+    collapsed = {}
+    for stack, line, instructions in costs:
+        # ; separates the frames
+        key = ";".join(name.replace(";", ",") for name in stack + [line])
+        collapsed[key] = collapsed.get(key, 0) + instructions
+
+    for key, instructions in sorted(collapsed.items()):
+        out.write("{} {}\n".format(key, instructions))
+
+
+# Prints the top macros, by the instructions run inside them, and lines, by the
+# instructions of the code they generated themselves
+def print_source_profile(costs, top, out):
+    total = sum(instructions for _, _, instructions in costs)
+    macros = {} # {name: [total, self]}
+    lines = {}
+    for stack, line, instructions in costs:
+        # Counted once per macro, even if it invokes itself
+        for name in set(stack):
+            macros.setdefault(name, [0, 0])[0] += instructions
+        if len(stack) > 0:
+            macros[stack[-1]][1] += instructions
+        lines[line] = lines.get(line, 0) + instructions
+
+    def percent(instructions):
+        return "{:.1f}%".format(100 * instructions / max(total, 1))
+
+    print("\nMacros:", file=out)
+    print("{:>14} {:>6} {:>14} {:>6}  macro".format("instructions", "", "self", ""), file=out)
+    for name, (instructions, self_instructions) in sorted(macros.items(), key=lambda item: -item[1][0])[:top]:
+        print("{:>14} {:>6} {:>14} {:>6}  {}".format(
+            instructions, percent(instructions), self_instructions, percent(self_instructions), name), file=out)
+
+    print("\nLines:", file=out)
+    print("{:>14} {:>6}  line".format("instructions", ""), file=out)
+    for line, instructions in sorted(lines.items(), key=lambda item: -item[1])[:top]:
+        print("{:>14} {:>6}  {}".format(instructions, percent(instructions), line), file=out)
+
+
+def print_break(ip, mp, executed, location=()):
+    print("Hit breakpoint {} after {} instructions, MP={}".format(ip, executed, hex(mp)), file=sys.stderr)
+    for line in location:
+        print("  " + line, file=sys.stderr)
+
+
+# Returns the exit code
+def run_batch(units, source_map, args):
+    tape = Tape(min(TAPE_PREALLOC, args.tape_limit or TAPE_PREALLOC), args.tape_limit)
+    output = OutputSink(raw=args.raw_output)
+    profile = Profile(units) if args.profile else None
+
+    if args.profile_collapsed is not None and source_map is None:
+        print("Error: --profile-collapsed needs a bfpp file, compiled with -c", file=sys.stderr)
+        return EXIT_ERROR
 
-    code_units = parse_code(code_str)
-    return code_units
+    breakpoints = set()
+    try:
+        for bp in args.breakpoints:
+            breakpoints |= resolve_breakpoint(bp, units, source_map)
+    except BreakpointError as e:
+        print("Error:", e, file=sys.stderr)
+        return EXIT_ERROR
+
+    def on_break(ip, mp, executed):
+        print_break(ip, mp, executed, describe_location(units, source_map, ip))
+
+    if args.input == "-":
+        input_file = sys.stdin.buffer
+    else:
+        input_file = open(args.input, "rb")
+
+    def read_input():
+        # Whatever is there, so that programs reading from a pipe can answer
+        # each line as it comes
+        output.flush()
+        more = input_file.read1(1 << 16)
+        if len(more) == 0 and args.eof is not None:
+            return [args.eof]
+        return list(more)
+
+    timed_out = False
+
+    def on_alarm(signum, frame):
+        nonlocal timed_out
+        timed_out = True
+        interrupt_run()
+
+    try:
+        if args.timeout is not None:
+            signal.signal(signal.SIGALRM, on_alarm)
+            signal.setitimer(signal.ITIMER_REAL, args.timeout)
+        executed, reason = run_program(units, tape, output, [], breakpoints, args.max_steps, on_break, read_input, profile)
+    except KeyboardInterrupt:
+        # Arrived outside of run_until_break
+        executed, reason = None, RUN_INTERRUPT
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        output.flush()
+        if input_file is not sys.stdin.buffer:
+            input_file.close()
+
+    # Also for runs that didn't finish, which are often the interesting ones
+    if profile is not None:
+        print_profile(units, profile, args.profile_top, sys.stderr)
+        if args.profile_json is not None:
+            with open(args.profile_json, "w") as f:
+                json.dump(profile.to_json(), f)
+
+        if source_map is not None:
+            costs = source_costs(units, source_map, profile)
+            print_source_profile(costs, args.profile_top, sys.stderr)
+            if args.profile_collapsed is not None:
+                with open(args.profile_collapsed, "w") as f:
+                    write_collapsed(costs, f)
+
+    if reason is None:
+        return EXIT_OK
+
+    if reason == RUN_INTERRUPT and timed_out:
+        print("\nTimed out after {} seconds".format(args.timeout), file=sys.stderr)
+        return EXIT_TIMEOUT
+    if reason == RUN_INTERRUPT:
+        return EXIT_INTERRUPT
+    if reason == RUN_STEP_LIMIT:
+        print("\nStopped after {} instructions".format(executed), file=sys.stderr)
+        return EXIT_TIMEOUT
+    if reason == RUN_TAPE_LIMIT:
+        print("\nTape limit of {} cells reached".format(tape.limit), file=sys.stderr)
+        return EXIT_TAPE_LIMIT
+    print("\n, reached without input left", file=sys.stderr)
+    return EXIT_INPUT
 
 if __name__ == "__main__":
+    # Strips colour codes when not printing to a terminal, which importing
+    # the compiler used to take care of
+    colorama.init()
+
+    arg_parser = argparse.ArgumentParser(description="Debugger for bf programs")
+    arg_parser.add_argument("file", help="bf file to run, or bfpp file with -c")
+    arg_parser.add_argument("-c", dest="compile_bfpp", action="store_true", help="compile the file with bfpp first")
+    arg_parser.add_argument("-O", dest="optimize", action="store_true", help="replace common loops such as [-] and [->+<] with single units")
+    arg_parser.add_argument("--no-cache", dest="use_cache", action="store_false", help="always compile and parse the file, without using " + CACHE_DIR)
+    arg_parser.add_argument("--raw-output", dest="raw_output", action="store_true", help="write the program's output as raw bytes instead of characters")
+    arg_parser.add_argument("--tape-limit", dest="tape_limit", type=int, default=None, help="maximum number of cells on the tape")
+
+    batch_args = arg_parser.add_argument_group("batch mode")
+    batch_args.add_argument("--run", action="store_true", help="just run the program, without the listing or any prompts")
+    batch_args.add_argument("--input", default="-", help="file to read the program's input from (default: stdin)")
+    batch_args.add_argument("--eof", type=int, default=None, help="value , reads once the input has ended (default: stop the program)")
+    batch_args.add_argument("-b", "--break", dest="breakpoints", action="append", default=[], help="print where the program is when it reaches this unit, or file:line with -c, can be repeated")
+    batch_args.add_argument("--max-steps", dest="max_steps", type=int, default=None, help="stop after about this many instructions")
+    batch_args.add_argument("--timeout", type=float, default=None, help="stop after this many seconds")
+
+    profile_args = arg_parser.add_argument_group("profiling")
+    profile_args.add_argument("--profile", action="store_true", help="count how often every unit runs and print the hottest loops, and with -c the hottest macros and lines, implies --run")
+    profile_args.add_argument("--profile-top", dest="profile_top", type=int, default=10, help="number of loops, macros and lines to print (default: 10)")
+    profile_args.add_argument("--profile-json", dest="profile_json", default=None, help="also write the counts to this file as JSON")
+    profile_args.add_argument("--profile-collapsed", dest="profile_collapsed", default=None, help="with -c, also write the instructions per macro stack and line to this file as collapsed stacks for flame graphs, implies --profile")
+    args = arg_parser.parse_args()
+
     instructions_total, insturctions_since_break = 0, 0
 
-    code_units = read_units(sys.argv[1:])
+    if args.profile_collapsed is not None:
+        args.profile = True
+    if args.profile:
+        args.run = True
+
+    try:
+        if args.run:
+            # Keep stdout for the program's output
+            with contextlib.redirect_stdout(sys.stderr):
+                code_units, code_str, source_map = read_units(args.file, args.compile_bfpp, args.optimize, args.use_cache)
+        else:
+            code_units, code_str, source_map = read_units(args.file, args.compile_bfpp, args.optimize, args.use_cache)
+    except UnmatchedBracketError as e:
+        print("Error:", e, file=sys.stderr if args.run else sys.stdout)
+        exit(EXIT_ERROR)
+
+    if args.run:
+        exit(run_batch(code_units, source_map, args))
+
+    if args.compile_bfpp:
+        print(code_str)
 
     for graph, line, cont in pretty_print_code_slice(code_units,
                                                      0,
@@ -239,20 +1960,14 @@ if __name__ == "__main__":
                                                      mark_inst=0):
         print("\033[38;5;2m%s|\033[38;5;3m%s \033[0m%s" % (graph, line, cont))
 
-    memory = []
+    memory = Tape(min(TAPE_PREALLOC, args.tape_limit or TAPE_PREALLOC), args.tape_limit)
     input_feed = []
 
     def get_mem(mp):
-        global memory
-        if mp < len(memory):
-            return memory[mp]
-        return 0
+        return memory[mp]
 
     def set_mem(mp, val):
-        global memory
-        if mp >= len(memory):
-            memory += [0] * (mp - len(memory) + 1)
-        memory[mp] = val % 256
+        memory[mp] = val
 
     step_once = False
     last_line = ""
@@ -260,10 +1975,14 @@ if __name__ == "__main__":
     def menu():
         global breakpoints, IP, output, step_once, last_line, input_feed, memory
 
-        print("Output:", output)
+        output.flush()
+        print("Output:", list(output.history))
         print("Has run {} instructions, {} since last break".format(instructions_total, insturctions_since_break))
         print("MP=", hex(MP))
 
+        for line in describe_location(code_units, source_map, IP):
+            print(line)
+
         for graph, line, cont in pretty_print_code_slice(code_units,
                                                          max(0, IP - 5),
                                                          min(
@@ -312,8 +2031,10 @@ if __name__ == "__main__":
                             input_feed = set_input
 
             if cmd[:2] == "ba":
-                at = ast.literal_eval(cmd[2:])
-                breakpoints = breakpoints | set([at])
+                try:
+                    breakpoints = breakpoints | resolve_breakpoint(cmd[2:], code_units, source_map)
+                except BreakpointError as e:
+                    print("Error:", e)
                 print("Breakpoints at", breakpoints)
 
             if cmd[0] == "d":
@@ -343,8 +2064,10 @@ if __name__ == "__main__":
                           (graph, line, cont))
 
             if cmd[:2] == "bd":
-                at = ast.literal_eval(cmd[2:])
-                breakpoints = breakpoints.difference(set([at]))
+                try:
+                    breakpoints = breakpoints - resolve_breakpoint(cmd[2:], code_units, source_map)
+                except BreakpointError as e:
+                    print("Error:", e)
                 print("Breakpoints at", breakpoints)
 
             if cmd[:2] == "bl":
@@ -439,7 +2162,12 @@ if __name__ == "__main__":
 
     print("Enter breakpoints:")
     bps = input()
-    if bps != "":
+    if ":" in bps:
+        try:
+            breakpoints = resolve_breakpoint(bps, code_units, source_map)
+        except BreakpointError as e:
+            print("Error:", e)
+    elif bps != "":
         bps = ast.literal_eval(bps)
 
         if type(bps) == "tuple":
@@ -449,39 +2177,42 @@ if __name__ == "__main__":
 
     breakpoints = breakpoints | set([len(code_units)])
 
-    output = []
+    output = OutputSink(args.raw_output)
+    atexit.register(output.flush)
 
     def run_instruction():
         global IP, MP, output, input, input_feed, instructions_total, insturctions_since_break
         instructions_total += 1
         insturctions_since_break += 1
-        if code_units[IP].typ == Unit.INCDEC:
-            set_mem(MP, (get_mem(MP) + code_units[IP].param) % 256)
+        typ = code_units.typs[IP]
+        param = code_units.params[IP]
+        if typ == Unit.INCDEC:
+            set_mem(MP, (get_mem(MP) + param) % 256)
             IP += 1
 
-        elif code_units[IP].typ == Unit.MOV:
-            MP += code_units[IP].param
+        elif typ == Unit.MOV:
+            MP += param
             IP += 1
 
-        elif code_units[IP].typ == Unit.JUMP_FORWARD:
+        elif typ == Unit.JUMP_FORWARD:
             if get_mem(MP) == 0:
-                IP = code_units[IP].param + 1
+                IP = param + 1
             else:
                 IP += 1
 
-        elif code_units[IP].typ == Unit.JUMP_BACKWARD:
+        elif typ == Unit.JUMP_BACKWARD:
             if get_mem(MP) != 0:
-                IP = code_units[IP].param + 1
+                IP = param + 1
             else:
                 IP += 1
 
-        elif code_units[IP].typ == Unit.PRINT:
-            output += [get_mem(MP)]
-            print(chr(get_mem(MP)), end="", flush=True)
+        elif typ == Unit.PRINT:
+            output.write(get_mem(MP))
             IP += 1
 
-        elif code_units[IP].typ == Unit.READ:
+        elif typ == Unit.READ:
             if len(input_feed) == 0:
+                output.flush()
                 print(", reached without input left.")
                 print("Use the i command to supply input")
                 menu()
@@ -489,12 +2220,66 @@ if __name__ == "__main__":
                 set_mem(MP, input_feed[0])
                 input_feed = input_feed[1:]
                 IP += 1
+
+        elif typ == Unit.SET_ZERO:
+            set_mem(MP, 0)
+            IP += 1
+
+        elif typ == Unit.MUL_ADD:
+            # mul_add and scan index cells directly, so MP has to be on the tape
+            at = MP + memory.origin
+            at += memory.fit(at, at)
+            # Growing the tape moves the origin along with the cells
+            MP = mul_add(memory, at, code_units.param(IP)) - memory.origin
+            IP += 1
+
+        elif typ == Unit.SCAN:
+            at = MP + memory.origin
+            at += memory.fit(at, at)
+            MP = scan(memory, at, param) - memory.origin
+            IP += 1
         else:
             IP += 1
 
+    ops, params = flatten_units(code_units)
+    offset_program = None
+    offset_program_breakpoints = None
+
+    def run_fast():
+        global IP, MP, instructions_total, insturctions_since_break, offset_program, offset_program_breakpoints
+
+        if offset_program_breakpoints != breakpoints:
+            offset_program = OffsetProgram(ops, params, stops_for(breakpoints, len(code_units)))
+            offset_program_breakpoints = breakpoints
+
+        entry = offset_program.enter(IP, MP)
+        if entry is None:
+            # Step until we're somewhere the lowered program can start
+            run_instruction()
+            return
+
+        ip, mp, already_run = entry
+        ip, mp, executed, reason = run_until_break(offset_program, memory, ip, mp, output, input_feed)
+        IP, MP, moves_run = offset_program.leave(ip, mp)
+        executed += moves_run - already_run
+
+        instructions_total += executed
+        insturctions_since_break += executed
+
+        if reason == RUN_INPUT:
+            # Let run_instruction deal with asking for input
+            run_instruction()
+        if reason == RUN_INTERRUPT:
+            menu()
+        if reason == RUN_TAPE_LIMIT:
+            output.flush()
+            print("\nTape limit of {} cells reached".format(memory.limit))
+            menu()
+
     while IP <= len(code_units):
         try:
             if IP in breakpoints:
+                output.flush()
                 print("\nHit breakpoint {}".format(IP))
                 menu()
                 insturctions_since_break = 0
@@ -507,6 +2292,13 @@ if __name__ == "__main__":
             if IP == len(code_units):
                 break
 
-            run_instruction()
+            if step_once:
+                run_instruction()
+            else:
+                run_fast()
         except KeyboardInterrupt as _:
             menu()
+        except TapeLimitError as e:
+            output.flush()
+            print("\n" + str(e))
+            menu()